@@ -4,7 +4,9 @@ License:
 Author: Sam Mansfield
 """
 import configparser
+import queue
 import sys
+import threading
 import time
 from pimap import pimapanalyzeobjectivemobility as paom
 from pimap import pimapstorekafka as pstk
@@ -15,22 +17,55 @@ store_port = 9092
 max_pressure = 100.0
 sample_type = "pressure_bandage"
 sleep_time = 1.0
+# PIMAP metrics are batched and stored once per store_period or once the batch
+# reaches store_limit, whichever comes first. Storing larger batches amortizes the
+# per-call overhead of PIMAP Store.
+store_limit = 1000
+store_period = 1.0
 
 # If a pimap_config.ini file is present in the current directory use the config values.
 config = configparser.ConfigParser()
 config.read("pimap_config.ini")
 name = sys.argv[0]
+# Casts applied to config values; options without a cast are kept as strings.
+casts = {"store_port":int, "max_pressure":float, "sleep_time":float,
+         "store_limit":int, "store_period":float}
 if name in config:
-  if "store_host" in config[name]: store_host = config[name]["store_host"]
-  if "store_port" in config[name]: store_port = config[name]["store_port"]
-  if "max_pressure" in config[name]: max_pressure = float(config[name]["max_pressure"])
-  if "sample_type" in config[name]: sample_type = config[name]["sample_type"]
-  if "sleep_time" in config[name]: sleep_time = float(config[name]["sleep_time"])
+  for key, value in config[name].items():
+    globals()[key] = casts.get(key, str)(value)
 
 analyze = paom.PimapAnalyzeObjectiveMobility(max_pressure)
 store = pstk.PimapStoreKafka(store_host, store_port)
 
+# Retrieve, analyze, and store are pipelined over bounded queues so the network
+# waits of retrieve and store overlap with the analysis. The bounded queues apply
+# backpressure if one stage falls behind.
+retrieved_queue = queue.Queue(maxsize=4)
+analyzed_queue = queue.Queue(maxsize=4)
+
+def retrieve_worker():
+  # Instead of sleeping between retrieve calls, retrieve blocks inside the Kafka
+  # client for up to sleep_time. This wakes the worker as soon as samples arrive
+  # and idles cheaply when the topic is empty.
+  while True:
+    retrieved_queue.put(store.retrieve(sample_type, timeout=sleep_time))
+
+def analyze_worker():
+  while True:
+    analyzed_queue.put(analyze.analyze(retrieved_queue.get()))
+
+threading.Thread(target=retrieve_worker, daemon=True).start()
+threading.Thread(target=analyze_worker, daemon=True).start()
+
+metric_batch = []
+last_time_stored = time.time()
 while True:
-  pimap_metrics = analyze.analyze(store.retrieve(sample_type))
-  store.store(pimap_metrics)
-  time.sleep(sleep_time)
+  try:
+    metric_batch.extend(analyzed_queue.get(timeout=store_period))
+  except queue.Empty:
+    pass
+  if (len(metric_batch) >= store_limit or
+      time.time() - last_time_stored > store_period):
+    store.store(metric_batch)
+    metric_batch = []
+    last_time_stored = time.time()
@@ -6,7 +6,6 @@ Author: Sam Mansfield
 import ast
 import configparser
 import sys
-import time
 from pimap import pimapstorekafka as pstk
 from pimap import pimapvisualizepltgraph as pvplt
 
@@ -15,24 +14,24 @@ store_host = "localhost"
 store_port = 9092
 visualize_keys = ["xy_gradient"]
 metric_type = "objective_mobility"
+# How long retrieve blocks waiting for new metrics before the loop comes around.
 sleep_time = 1.0
 
 # If a pimap_config.ini file is present in the current directory use the config values.
 config = configparser.ConfigParser()
 config.read("pimap_config.ini")
 name = sys.argv[0]
+# Casts applied to config values; options without a cast are kept as strings.
+casts = {"store_port":int, "visualize_keys":ast.literal_eval, "sleep_time":float}
 if name in config:
-  if "store_host" in config[name]: store_host = config[name]["store_host"]
-  if "store_port" in config[name]: store_port = config[name]["store_port"]
-  if "visualize_keys" in config[name]:
-    visualize_keys = ast.literal_eval(config[name]["visualize_keys"])
-  if "metric_type" in config[name]: metric_type = config[name]["metric_type"]
-  if "sleep_time" in config[name]: sleep_time = float(config[name]["sleep_time"])
+  for key, value in config[name].items():
+    globals()[key] = casts.get(key, str)(value)
 
 store = pstk.PimapStoreKafka(store_host, store_port)
-visualize_keys = ["xy_gradient"]
 visualize = pvplt.PimapVisualizePltGraph(visualize_keys)
 
+# Instead of sleeping between retrieve calls, retrieve blocks inside the Kafka
+# client for up to sleep_time. This wakes the loop as soon as metrics arrive and
+# idles cheaply when the topic is empty.
 while True:
-  visualize.visualize(store.retrieve(metric_type))
-  time.sleep(sleep_time)
+  visualize.visualize(store.retrieve(metric_type, timeout=sleep_time))
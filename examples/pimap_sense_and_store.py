@@ -15,21 +15,32 @@ sense_port = 31415
 store_host = "localhost"
 store_port = 9092
 sleep_time = 1.0
+# Sensed PIMAP data is batched and stored once per store_period or once the batch
+# reaches store_limit, whichever comes first. Storing larger batches amortizes the
+# per-call overhead of PIMAP Store.
+store_limit = 1000
+store_period = 1.0
 
 # If a pimap_config.ini file is present in the current directory use the config values.
 config = configparser.ConfigParser()
 config.read("pimap_config.ini")
 name = sys.argv[0]
+# Casts applied to config values; options without a cast are kept as strings.
+casts = {"sense_port":int, "store_port":int, "sleep_time":float,
+         "store_limit":int, "store_period":float}
 if name in config:
-  if "sense_host" in config[name]: sense_host = config[name]["sense_host"]
-  if "sense_port" in config[name]: sense_port = int(config[name]["sense_port"])
-  if "store_host" in config[name]: store_host = config[name]["store_host"]
-  if "store_port" in config[name]: store_port = int(config[name]["store_port"])
-  if "sleep_time" in config[name]: sleep_time = float(config[name]["sleep_time"])
+  for key, value in config[name].items():
+    globals()[key] = casts.get(key, str)(value)
 
 sense = pseu.PimapSenseUdp(sense_host, sense_port)
 store = pstk.PimapStoreKafka(store_host, store_port)
 
+batch = []
+last_time_stored = time.time()
 while True:
-  store.store(sense.sense())
+  batch.extend(sense.sense())
+  if len(batch) >= store_limit or time.time() - last_time_stored > store_period:
+    store.store(batch)
+    batch = []
+    last_time_stored = time.time()
   time.sleep(sleep_time)
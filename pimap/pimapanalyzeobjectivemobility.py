@@ -27,15 +27,35 @@ License:
 Author: Sam Mansfield
 """
 import ast
+import json
 import numpy as np
 import sys
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
 from pimap import pimaputilities as pu
 
+def parse_sample_data(sample_string):
+  """Parses the data field of a pressure_bandage PIMAP sample into a dictionary.
+
+  JSON is tried first, as json.loads is orders of magnitude faster than a full
+  Python-AST parse. Samples serialized with str(dict), which uses single quotes,
+  are not valid JSON and fall back to ast.literal_eval.
+
+  Arguments:
+    sample_string: The data field of a PIMAP sample as a string.
+
+  Returns:
+    Returns the parsed data as a dictionary.
+  """
+  try:
+    return json.loads(sample_string)
+  except ValueError:
+    return ast.literal_eval(sample_string)
+
 class PimapAnalyzeObjectiveMobility:
   def __init__(self, max_pressure=100.0, sample_type="pressure_bandage",
-               system_samples=False, app=""):
+               system_samples=False, app="", dtype=np.float64):
     """Constructor for PIMAP Analyze Objective Mobility
 
     Arguments:
@@ -49,15 +69,23 @@ class PimapAnalyzeObjectiveMobility:
       app (optional): A name of the application running, which is used to append
         to the name of they sample_type of system_samples,
         e.g. sample_type:"system_samples_app". Defaults to "".
+      dtype (optional): The NumPy dtype used for the pressure bandage arrays and the
+        angle math. np.float32 halves memory traffic and doubles SIMD throughput at
+        slightly reduced angle precision, which is more than enough for angles
+        reported in degrees. Defaults to np.float64, which keeps the published
+        angle values bit-identical to previous releases.
 
     Exceptions:
       ValueError:
         If a non-float max_pressure is given.
     """
     self.max_pressure = float(max_pressure)
+    self.dtype = np.dtype(dtype)
     self.sample_type = str(sample_type)
     self.system_samples = system_samples
-    self.system_samples_updated = time.time()
+    # The monotonic clock is used for all durations and period checks; the wall
+    # clock is only used for timestamps and latencies, which are epoch based.
+    self.system_samples_updated = time.monotonic()
     self.system_samples_update_period = 1.0
     self.samples_in = 0
     self.metrics_out = 0
@@ -68,20 +96,37 @@ class PimapAnalyzeObjectiveMobility:
     self.app = str(app)
 
     self.aggregation_buffer = []
+    # The aggregation limit adapts with additive increase/multiplicative decrease
+    # and is kept an integer clamped to [min, max], so it can neither decay toward
+    # zero (starving the pipeline) nor grow without bound (exhausting memory).
     self.aggregation_limit = 100
+    self.aggregation_limit_min = 32
+    self.aggregation_limit_max = 8192
+    self.aggregation_limit_increment = 32
     self.aggregation_period = 0.05
     self.analyze_period = 0.05
-    self.last_time_analyzed = time.time()
+    self.last_time_analyzed = time.monotonic()
 
     # This is used to calculate the xy gradient when we have enough x and y angle
     # PIMAP metrics based on the gradient_period.
+    # Deques are used instead of lists as the movements per minute calculation pops
+    # from the front of the saved buffers, which is O(N) per pop on a list.
     self.gradient_period = 5
-    self.saved_angle_pmetrics_by_id = defaultdict(list)
+    self.saved_angle_pmetrics_by_id = defaultdict(deque)
 
     # This is used to calculate movements per minute when we have enough
     # xy gradient PIMAP samples based on the movements_per_min_period.
     self.movements_per_min_period = 3600
-    self.saved_gradient_pmetrics_by_id = defaultdict(list)
+    self.saved_gradient_pmetrics_by_id = defaultdict(deque)
+
+    # Scratch buffers reused across analyze calls by the vectorized gradient
+    # computation, grown as needed (see analyze).
+    self._x_gradient_scratch = np.empty(0)
+    self._y_gradient_scratch = np.empty(0)
+    # Named scratch buffers reused across analyze calls by the angle computation,
+    # grown as needed (see _batch_scratch). Reuse is safe because only scalar
+    # copies of the buffer contents outlive an analyze call.
+    self._batch_scratch_buffers = {}
 
     # Centroid 0
     # locations (x, y): (0, 0), (1, 0), (2, 0), (3, 0), (2, 1), (3, 2)
@@ -108,6 +153,49 @@ class PimapAnalyzeObjectiveMobility:
     self.c2_mean_x = np.mean(self.c2_xlocs/3.0)
     self.c2_mean_y = np.mean(self.c2_ylocs/3.0)
 
+    # Flattened (y*4 + x) indices into a (N, 16) view of the pressure bandage
+    # data. take with a single flat index array uses contiguous linear indexing,
+    # which is faster than fancy indexing with two index arrays (see analyze).
+    self.c0_flat_locs = (self.c0_ylocs*4 + self.c0_xlocs).astype(np.intp)
+    self.c1_flat_locs = (self.c1_ylocs*4 + self.c1_xlocs).astype(np.intp)
+    self.c2_flat_locs = (self.c2_ylocs*4 + self.c2_xlocs).astype(np.intp)
+    # Precomputed divisors for the explicit sum-then-divide centroid means.
+    self.c0_size = float(len(self.c0_flat_locs))
+    self.c1_size = float(len(self.c1_flat_locs))
+    self.c2_size = float(len(self.c2_flat_locs))
+
+    # The x and y components of the two in-plane vectors used in analyze depend
+    # only on the constant centroid coordinates, so they are computed once here.
+    # The same is true of the z component of the plane normal.
+    self.vector0_x = self.c1_mean_x - self.c0_mean_x
+    self.vector0_y = self.c1_mean_y - self.c0_mean_y
+    self.vector1_x = self.c2_mean_x - self.c0_mean_x
+    self.vector1_y = self.c2_mean_y - self.c0_mean_y
+    self.plane_c = self.vector0_x*self.vector1_y - self.vector0_y*self.vector1_x
+    # The factor that converts radians to degrees.
+    self.degrees_per_radian = 360/(2*np.pi)
+
+  def _batch_scratch(self, name, shape):
+    """Returns a reusable scratch array for one batch of aggregated samples.
+
+    Allocating the intermediate arrays of the angle computation fresh on every
+    analyze call costs about a dozen allocations per batch, so each named buffer
+    is kept across calls and only reallocated when a batch outgrows it.
+
+    Arguments:
+      name: The name of the scratch buffer.
+      shape: The requested shape. Only the first dimension is expected to vary
+        between calls for a given name.
+
+    Returns:
+      Returns a view of the named scratch buffer with the requested shape.
+    """
+    buffer = self._batch_scratch_buffers.get(name)
+    if buffer is None or buffer.shape[0] < shape[0] or buffer.dtype != self.dtype:
+      buffer = np.empty(shape, dtype=self.dtype)
+      self._batch_scratch_buffers[name] = buffer
+    return buffer[:shape[0]]
+
   def analyze(self, pimap_samples):
     """The core interaction of PIMAP Analyze Objective Mobility
 
@@ -129,106 +217,180 @@ class PimapAnalyzeObjectiveMobility:
     if not isinstance(pimap_samples, list):
       raise TypeError("The argument pimap_samples must be a list.")
 
-    valid_pimap_samples = list(map(pu.validate_datum, pimap_samples))
-    # If pimap_samples is an empty list we still want to continue, this way we can 
+    # Validate, filter, and parse in a single pass over pimap_samples. parse_datum
+    # raises ValueError on non-PIMAP data. Each aggregated sample is kept as a
+    # (pimap_sample, parsed fields) pair so nothing below re-parses the string.
+    # If pimap_samples is an empty list we still want to continue, this way we can
     # still return system_samples.
-    if not any(valid_pimap_samples) and len(pimap_samples) != 0:
-      raise ValueError("Invalid data in pimap_samples.")
-
-    filtered_pimap_samples = list(filter(lambda x: pu.get_type(x) == self.sample_type,
-                                         pimap_samples))
-    self.aggregation_buffer.extend(filtered_pimap_samples)
+    filtered_parsed_samples = []
+    for pimap_sample in pimap_samples:
+      parsed = pu.parse_datum(pimap_sample)
+      if parsed["type"] == self.sample_type:
+        filtered_parsed_samples.append((pimap_sample, parsed))
+    self.aggregation_buffer.extend(filtered_parsed_samples)
     pimap_metrics = []
+    # The clock is read once here instead of repeatedly in the hot path below.
+    start_time_to_analyze = time.monotonic()
     if ((len(self.aggregation_buffer) > self.aggregation_limit or
-         time.time() - self.last_time_analyzed > self.aggregation_period) and
-        len(self.aggregation_buffer) > 0):
-      self.last_time_analyzed = time.time()
-      start_time_to_analyze = time.time()
-
-      raw_pressure_bandage_string = list(map(pu.get_sample, self.aggregation_buffer))
-      raw_pressure_bandage_dict = np.array(list(map(ast.literal_eval,
-                                                    raw_pressure_bandage_string)))
-      raw_pressure_bandage = np.array(list(map(lambda x: x["pressure_bandage"],
-                                               raw_pressure_bandage_dict)))
-      normalized_pressure_bandage = raw_pressure_bandage/self.max_pressure
-
-      # The centroid data format is [x, y, mean_pressure]
-      c0 = np.empty((len(normalized_pressure_bandage), 3))
-      c0[:, 0] = self.c0_mean_x
-      c0[:, 1] = self.c0_mean_y
-      # The mean of the pressure values of all pressure bandage data for centroid 0.
-      c0[:, 2] = np.mean(normalized_pressure_bandage[:, self.c0_ylocs, self.c0_xlocs],
-                         axis=1)
-      c1 = np.empty((len(normalized_pressure_bandage), 3))
-      c1[:, 0] = self.c1_mean_x
-      c1[:, 1] = self.c1_mean_y
-      c1[:, 2] = np.mean(normalized_pressure_bandage[:, self.c1_ylocs, self.c1_xlocs],
-                         axis=1)
-      c2 = np.empty((len(normalized_pressure_bandage), 3))
-      c2[:, 0] = self.c2_mean_x
-      c2[:, 1] = self.c2_mean_y
-      c2[:, 2] = np.mean(normalized_pressure_bandage[:, self.c2_ylocs, self.c2_xlocs],
-                         axis=1)
+         start_time_to_analyze - self.last_time_analyzed > self.aggregation_period)
+        and len(self.aggregation_buffer) > 0):
+      self.last_time_analyzed = start_time_to_analyze
+
+      parsed_buffer = list(map(lambda x: x[1], self.aggregation_buffer))
+      # The parsed pressure lists go straight into one numeric array. Collecting
+      # the parsed dictionaries into an intermediate object ndarray first would
+      # only add allocations and another pass over the batch.
+      raw_pressure_bandage = np.array(list(map(
+        lambda x: parse_sample_data(x["data"])["pressure_bandage"], parsed_buffer)),
+        dtype=self.dtype)
+      batch_size = len(raw_pressure_bandage)
+
+      # The mean of the normalized pressure values of all pressure bandage data
+      # per centroid, gathered through a flat view with the precomputed flat
+      # indices. The gathered values are taken from the raw data and normalized
+      # in place, so only the 17 centroid elements of each sample are divided by
+      # max_pressure instead of all 32. The mean is then an explicit
+      # np.add.reduce followed by the precomputed divisor, which matches
+      # np.mean's internals exactly. max_pressure and the divisor are not fused
+      # into one reciprocal scale as multiplying by a reciprocal is not
+      # bit-identical to dividing.
+      flat_pressure_bandage = raw_pressure_bandage.reshape(batch_size, -1)
+      c0_pressure_bandage = flat_pressure_bandage.take(
+        self.c0_flat_locs, axis=1,
+        out=self._batch_scratch("c0", (batch_size, len(self.c0_flat_locs))))
+      c1_pressure_bandage = flat_pressure_bandage.take(
+        self.c1_flat_locs, axis=1,
+        out=self._batch_scratch("c1", (batch_size, len(self.c1_flat_locs))))
+      c2_pressure_bandage = flat_pressure_bandage.take(
+        self.c2_flat_locs, axis=1,
+        out=self._batch_scratch("c2", (batch_size, len(self.c2_flat_locs))))
+      c0_pressure_bandage /= self.max_pressure
+      c1_pressure_bandage /= self.max_pressure
+      c2_pressure_bandage /= self.max_pressure
+      p0 = np.add.reduce(c0_pressure_bandage, axis=1,
+                         out=self._batch_scratch("p0", (batch_size,)))
+      p0 /= self.c0_size
+      p1 = np.add.reduce(c1_pressure_bandage, axis=1,
+                         out=self._batch_scratch("p1", (batch_size,)))
+      p1 /= self.c1_size
+      p2 = np.add.reduce(c2_pressure_bandage, axis=1,
+                         out=self._batch_scratch("p2", (batch_size,)))
+      p2 /= self.c2_size
 
       # We now find the plane that contains the three centroids.
       # Equation of a plane: ax + by + cz = d
       # Normal to a plane: n = [a; b; c]
-      vector0 = c1 - c0
-      vector1 = c2 - c0
-      n = np.cross(vector0, vector1)
-      a = n[:, 0]
-      b = n[:, 1]
-      c = n[:, 2]
-      # We could use any of the centroids, but we use centroid 0.
-      d = c0[:, 0]*a + c0[:, 1]*b + c0[:, 2]*c
+      # The x and y coordinates of the centroids are constants, so the cross product
+      # of the two in-plane vectors is expanded into scalar formulas and only the z
+      # (mean pressure) components vary per sample. This avoids allocating (N, 3)
+      # centroid arrays and the intermediate vectors of np.cross.
+      vector0_z = np.subtract(p1, p0, out=self._batch_scratch("vector0_z",
+                                                              (batch_size,)))
+      vector1_z = np.subtract(p2, p0, out=self._batch_scratch("vector1_z",
+                                                              (batch_size,)))
+      product = self._batch_scratch("product", (batch_size,))
+      a = np.multiply(vector1_z, self.vector0_y,
+                      out=self._batch_scratch("a", (batch_size,)))
+      np.subtract(a, np.multiply(vector0_z, self.vector1_y, out=product), out=a)
+      b = np.multiply(vector0_z, self.vector1_x,
+                      out=self._batch_scratch("b", (batch_size,)))
+      np.subtract(b, np.multiply(vector1_z, self.vector0_x, out=product), out=b)
 
       # We use the equation of the plane to calculate the angle of the x slope and
-      # y slope.
-      x_angle = 360*np.arctan(-a/c)/(2*np.pi)
-      y_angle = 360*np.arctan(-b/c)/(2*np.pi)
+      # y slope. Negating the plane_c divisor instead of the dividend gives the
+      # same IEEE result and saves a pass over each array.
+      x_angle = np.divide(a, -self.plane_c, out=a)
+      np.arctan(x_angle, out=x_angle)
+      x_angle *= self.degrees_per_radian
+      y_angle = np.divide(b, -self.plane_c, out=b)
+      np.arctan(y_angle, out=y_angle)
+      y_angle *= self.degrees_per_radian
 
       angle_metrics = list(map(lambda x, y: {"x_angle":x, "x_angle_units":"degrees",
                                              "y_angle":y, "y_angle_units":"degrees"},
                                x_angle, y_angle))
 
       angle_pimap_metrics = list(map(lambda x, y: pu.create_pimap_metric(
-                                                               self.metric_type, x, y),
+                                                            self.metric_type, x[0], y),
                                      self.aggregation_buffer, angle_metrics))
 
       # The gradient needs to be filtered by patient and device otherwise the gradient
       # will be calculated with respect to all patients and all devices in the given 
       # pimap_samples.
 
-      for pmetric in angle_pimap_metrics:
-        pid = pu.get_patient_id(pmetric)
-        did = pu.get_device_id(pmetric)
-        self.saved_angle_pmetrics_by_id[(pid, did)].append(pmetric)
-
+      # The patient_id and device_id of an angle PIMAP metric match those of the
+      # sample it was created from, so the already parsed fields are reused. The
+      # angle floats and the timestamp are saved alongside the PIMAP metric so the
+      # gradient and movements per minute calculations below do not have to parse
+      # the metric strings that were just created.
+      for pmetric, parsed, x_a, y_a in zip(angle_pimap_metrics, parsed_buffer,
+                                           x_angle, y_angle):
+        pid = parsed["patient_id"]
+        did = parsed["device_id"]
+        self.saved_angle_pmetrics_by_id[(pid, did)].append(
+          (pmetric, float(x_a), float(y_a), float(parsed["timestamp"])))
+
+      # Gather the ids that have saved enough angle PIMAP metrics based on the
+      # gradient_period, then compute the gradients of all gathered groups in one
+      # vectorized pass instead of calling np.gradient per (patient_id, device_id).
+      # I assume timestamps are already sorted.
       gradient_pimap_metrics = []
-      for pid, did in self.saved_angle_pmetrics_by_id:
-        saved_angle_pmetrics = self.saved_angle_pmetrics_by_id[(pid, did)]
-        if len(saved_angle_pmetrics) == 0:
-            continue
-        timestamps = list(map(lambda x: float(pu.get_timestamp(x)),
-                              saved_angle_pmetrics))
-        # I assume timestamps are already sorted.
-        if len(saved_angle_pmetrics) >= self.gradient_period:
-          angle_metrics = list(map(lambda x: ast.literal_eval(pu.get_metric(x)),
-                                   saved_angle_pmetrics))
-          x_angle = list(map(lambda x: float(x["x_angle"]), angle_metrics))
-          y_angle = list(map(lambda x: float(x["y_angle"]), angle_metrics))
-          x_gradient = np.abs(np.gradient(x_angle))
-          y_gradient = np.abs(np.gradient(y_angle))
-          xy_gradient = np.maximum(x_gradient, y_gradient)
-          gradient_metrics = list(map(lambda x: {"xy_gradient":x}, xy_gradient))
+      eligible_ids = list(filter(
+        lambda x: len(self.saved_angle_pmetrics_by_id[x]) >= self.gradient_period,
+        self.saved_angle_pmetrics_by_id))
+      if len(eligible_ids) > 0:
+        grouped_pmetrics = list(map(
+          lambda x: list(self.saved_angle_pmetrics_by_id[x]), eligible_ids))
+        group_sizes = list(map(len, grouped_pmetrics))
+        flat_entries = [entry for group in grouped_pmetrics for entry in group]
+        x_angle = np.fromiter(map(lambda x: x[1], flat_entries), dtype=np.float64,
+                              count=len(flat_entries))
+        y_angle = np.fromiter(map(lambda x: x[2], flat_entries), dtype=np.float64,
+                              count=len(flat_entries))
+
+        # Central differences in the interior and one-sided differences at each
+        # group boundary, which matches np.gradient applied to each group on its
+        # own. The interior pass may cross group boundaries, but the only affected
+        # positions are the group starts and ends, which are overwritten.
+        group_starts = np.cumsum([0] + group_sizes[:-1])
+        group_ends = np.cumsum(group_sizes) - 1
+        # The gradients are computed in place in scratch buffers that are reused
+        # across analyze calls, which avoids allocating intermediate arrays for
+        # the differences, the absolute values, and the maximum.
+        if self._x_gradient_scratch.size < len(flat_entries):
+          self._x_gradient_scratch = np.empty(len(flat_entries))
+          self._y_gradient_scratch = np.empty(len(flat_entries))
+        x_gradient = self._x_gradient_scratch[:len(flat_entries)]
+        y_gradient = self._y_gradient_scratch[:len(flat_entries)]
+        np.subtract(x_angle[2:], x_angle[:-2], out=x_gradient[1:-1])
+        np.subtract(y_angle[2:], y_angle[:-2], out=y_gradient[1:-1])
+        x_gradient[1:-1] /= 2.0
+        y_gradient[1:-1] /= 2.0
+        x_gradient[group_starts] = x_angle[group_starts + 1] - x_angle[group_starts]
+        x_gradient[group_ends] = x_angle[group_ends] - x_angle[group_ends - 1]
+        y_gradient[group_starts] = y_angle[group_starts + 1] - y_angle[group_starts]
+        y_gradient[group_ends] = y_angle[group_ends] - y_angle[group_ends - 1]
+        np.fabs(x_gradient, out=x_gradient)
+        np.fabs(y_gradient, out=y_gradient)
+        xy_gradient = np.maximum(x_gradient, y_gradient, out=x_gradient)
+
+        offset = 0
+        for id_pair, group, size in zip(eligible_ids, grouped_pmetrics, group_sizes):
+          group_xy_gradient = xy_gradient[offset:offset + size]
+          gradient_metrics = list(map(lambda x: {"xy_gradient":x},
+                                      group_xy_gradient))
           new_pimap_metrics = (list(map(lambda x, y: pu.create_pimap_metric(
-                                                           self.metric_type, x, y),
-                                        saved_angle_pmetrics, gradient_metrics)))
+                                                           self.metric_type, x[0], y),
+                                        group, gradient_metrics)))
+          offset += size
           gradient_pimap_metrics.extend(new_pimap_metrics)
-          # Save gradient pimap metrics for calculating movements per minute.
-          self.saved_gradient_pmetrics_by_id[(pid, did)].extend(new_pimap_metrics)
+          # Save gradient pimap metrics for calculating movements per minute. The
+          # gradient float and the timestamp are saved alongside each PIMAP metric.
+          self.saved_gradient_pmetrics_by_id[id_pair].extend(
+            zip(new_pimap_metrics, group_xy_gradient,
+                map(lambda x: x[3], group)))
           # Remove saved angle pimap metrics as we have already used them.
-          self.saved_angle_pmetrics_by_id[(pid, did)] = []
+          self.saved_angle_pmetrics_by_id[id_pair].clear()
 
       # Calculate the movements_per_min when we have saved more xy_gradient
       # metrics by patient and device than the movements_per_min_period.
@@ -236,13 +398,11 @@ class PimapAnalyzeObjectiveMobility:
       for pid, did in self.saved_gradient_pmetrics_by_id:
         saved_gradients = self.saved_gradient_pmetrics_by_id[(pid, did)]
         while len(saved_gradients) >= self.movements_per_min_period:
-          saved_gradients = saved_gradients[:self.movements_per_min_period]
-          timestamps = list(map(lambda x: float(pu.get_timestamp(x)),
-                              saved_gradients))
+          gradient_window = list(islice(saved_gradients, 0,
+                                        self.movements_per_min_period))
+          timestamps = list(map(lambda x: x[2], gradient_window))
           elapsed_time = timestamps[-1] - timestamps[0]
-          gradient_metrics = list(map(lambda x: ast.literal_eval(pu.get_metric(x)),
-                                      saved_gradients))
-          xy_gradient = list(map(lambda x: x["xy_gradient"], gradient_metrics))
+          xy_gradient = list(map(lambda x: x[1], gradient_window))
           movements_per_min = 60.0*np.sum(np.array(xy_gradient) > 2)/elapsed_time
           movements_per_min_metric = {}
           movements_per_min_metric["movements_per_min"] = movements_per_min
@@ -254,45 +414,50 @@ class PimapAnalyzeObjectiveMobility:
           new_pimap_metric = pu.create_pimap_metric(self.metric_type, temp_pimap_sample,
                                                     movements_per_min_metric)
           movements_per_min_pimap_metrics.append(new_pimap_metric)
-          # Remove 1 saved gradient PIMAP metrics as we are using a sliding window.
-          del self.saved_gradient_pmetrics_by_id[(pid, did)][0]
-          saved_gradients = self.saved_gradient_pmetrics_by_id[(pid, did)]
+          # Remove 1 saved gradient PIMAP metric as we are using a sliding window.
+          saved_gradients.popleft()
 
       # Calculate the time to analyze and adjust the aggregation limit as necessary.
-      time_to_analyze = time.time() - start_time_to_analyze
+      time_to_analyze = time.monotonic() - start_time_to_analyze
       if time_to_analyze > self.analyze_period:
-        self.aggregation_limit /= 2
+        self.aggregation_limit = max(self.aggregation_limit_min,
+                                     self.aggregation_limit//2)
       elif len(self.aggregation_buffer) >= self.aggregation_limit:
-        self.aggregation_limit += len(self.aggregation_buffer)
+        self.aggregation_limit = min(self.aggregation_limit_max,
+                                     self.aggregation_limit +
+                                       self.aggregation_limit_increment)
 
       pimap_metrics.extend(angle_pimap_metrics)
       pimap_metrics.extend(gradient_pimap_metrics)
       pimap_metrics.extend(movements_per_min_pimap_metrics)
       self.aggregation_buffer = []
 
-    timestamps = list(map(lambda x: float(pu.get_timestamp(x)), filtered_pimap_samples))
-    self.latencies.extend(time.time() - np.array(timestamps))
+    # Short-circuit the latency bookkeeping when everything was filtered out.
+    if len(filtered_parsed_samples) > 0:
+      timestamps = list(map(lambda x: float(x[1]["timestamp"]),
+                            filtered_parsed_samples))
+      self.latencies.extend(time.time() - np.array(timestamps))
     pimap_system_samples = []
     if self.system_samples:
-      self.samples_in += len(filtered_pimap_samples)
+      self.samples_in += len(filtered_parsed_samples)
       self.metrics_out += len(pimap_metrics)
-      if time.time() - self.system_samples_updated > self.system_samples_update_period:
+      now = time.monotonic()
+      if now - self.system_samples_updated > self.system_samples_update_period:
         sample_type = "system_samples"
         if self.app != "":
           sample_type += "_" + self.app
         patient_id = "analyze"
         device_id = self.metric_type
-        sample = {"throughput_in":(self.samples_in/
-                                    (time.time() - self.system_samples_updated)),
-                  "throughput_out":(self.metrics_out/
-                                     (time.time() - self.system_samples_updated)),
+        elapsed = now - self.system_samples_updated
+        sample = {"throughput_in":self.samples_in/elapsed,
+                  "throughput_out":self.metrics_out/elapsed,
                   "aggregation_limit":self.aggregation_limit,
                   "aggregation":len(self.aggregation_buffer)}
         if len(self.latencies) > 0:
           sample["latency"] = np.mean(self.latencies)
         pimap_system_samples.append(pu.create_pimap_sample(sample_type, patient_id,
                                                            device_id, sample))
-        self.system_samples_updated = time.time()
+        self.system_samples_updated = now
         self.samples_in = 0
         self.metrics_out = 0
         self.latencies = []
@@ -6,8 +6,10 @@ depends on the sentineltoolkit.
 License:
 Author: Eric Vin
 """
+import base64
 import time
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 from pimap import pimaputilities as pu
 from sentineltoolkit.sentinel_interface import SentinelInterfaceToolkit
@@ -28,15 +30,36 @@ class PimapSenseSentinel:
     self.patient_id = str(patient_id)
     self.device_id = str(device_id)
 
-  def sense(self):
-    raw_scan_results = self.sentinel_toolkit.send_scan_all(self.frequency_list)
+    # Calibration and pickling run on a background thread so the next scan over
+    # serial can start while the previous scan is still being packaged.
+    self.packaging_executor = ThreadPoolExecutor(max_workers=1)
+    self.packaging_future = None
+
+  def package_scan(self, raw_scan_results, scan_time):
     calibrated_scan_results = self.calibration_profile.calibrate_raw_sample(
       raw_scan_results)
 
-    string_scan_results = pickle.dumps(calibrated_scan_results, 0).decode()
+    # Pickle protocol 0 is the slow ASCII legacy protocol. Pickle with the highest
+    # protocol instead and base64-encode the bytes to fit the PIMAP string format.
+    pickled_scan_results = pickle.dumps(calibrated_scan_results,
+                                        pickle.HIGHEST_PROTOCOL)
+    string_scan_results = base64.b64encode(pickled_scan_results).decode("ascii")
+
+    return pu.create_pimap_sample("SentinelBandage", self.patient_id,
+                                  self.device_id, string_scan_results, scan_time)
+
+  def sense(self):
+    raw_scan_results = self.sentinel_toolkit.send_scan_all(self.frequency_list)
+    scan_time = time.time()
 
-    pimap_sample = pu.create_pimap_sample("SentinelBandage", self.patient_id,
-                                          self.device_id, string_scan_results,
-                                          time.time())
+    # The scan just taken is handed to the packaging thread and the scan packaged
+    # during this scan is returned, so sense runs one scan behind. The first call
+    # returns an empty list as nothing has been packaged yet.
+    previous_future = self.packaging_future
+    self.packaging_future = self.packaging_executor.submit(self.package_scan,
+                                                           raw_scan_results,
+                                                           scan_time)
+    if previous_future is None:
+      return []
 
-    return [pimap_sample]
+    return [previous_future.result()]
@@ -6,17 +6,191 @@ host and port. PIMAP Sense TCP supports both IPv4 and IPv6.
 License:
 Author: Sam Mansfield
 """
-import ast
 import ctypes
 import multiprocessing
-import numpy as np
+import operator
+import os
+import queue
+import selectors
 import socket
+import threading
 import time
 from pimap import pimaputilities as pu
 
+# The worker targets live at module level and receive only the state they need
+# through args. Passing a bound method to a worker instead would drag the whole
+# PimapSenseTcp instance along, which the spawn start method pickles in full.
+
+def _pin_worker(pin_workers, worker_index):
+  """Pins the calling worker to one CPU, round robin over the available CPUs.
+
+  A pinned worker keeps its L1/L2 caches warm and is never migrated across
+  cores by the scheduler. Only active when pin_workers is set and the platform
+  supports affinities.
+
+  Arguments:
+    pin_workers: Whether pinning is enabled.
+    worker_index: The index of the worker across all worker types.
+  """
+  if pin_workers and hasattr(os, "sched_setaffinity"):
+    os.sched_setaffinity(0, {worker_index % os.cpu_count()})
+
+def _create_pimap_data_and_add_to_queue(running, received_address_queue,
+                                        pimap_data_queue, sample_type,
+                                        pin_workers, worker_index):
+  """Worker that turns received frames into PIMAP data.
+
+  Arguments:
+    running: A shared boolean value that keeps the worker alive.
+    received_address_queue: The queue of (frames, address) pairs from the sense
+      workers.
+    pimap_data_queue: The queue that batches of (timestamp, datum) pairs are
+      put on for sense().
+    sample_type: The sample type given to non-pimap sensed data.
+    pin_workers: Whether the worker pins itself to one CPU.
+    worker_index: The index of the worker across all worker types.
+  """
+  _pin_worker(pin_workers, worker_index)
+  # The pimaputilities functions are hoisted to locals once per worker, as each
+  # pu.* access in the per-datum loop below costs a module attribute lookup.
+  parse_datum = pu.parse_datum
+  create_pimap_sample = pu.create_pimap_sample
+  while running.value:
+    # A blocking get parks this worker in the kernel while the queue is empty
+    # instead of spinning on empty(), which burns a core and races with other
+    # workers between the empty() check and the get().
+    try:
+      (processed, address) = received_address_queue.get(timeout=0.1)
+    except queue.Empty:
+      continue
+    # Each datum is parsed exactly once with the single-pass parser, which
+    # validates it and yields every field in one scan, and the parsed timestamp
+    # is queued alongside the datum so sense() never reparses the strings.
+    # Every PIMAP datum contains "type:", so the C-level substring check rejects
+    # non-PIMAP data without running the parsing regex.
+    # Assume that if there is one valid PIMAP datum than all the data is PIMAP data.
+    pimap_data = []
+    try:
+      if b"type:" not in processed[0]:
+        raise ValueError("Non-PIMAP data.")
+      for frame in processed:
+        pimap_datum = frame.decode()
+        parsed = parse_datum(pimap_datum)
+        pimap_data.append((float(parsed["timestamp"]), pimap_datum))
+    except ValueError:
+      pimap_data = []
+      timestamp = time.time()
+      for frame in processed:
+        patient_id = address[0]
+        device_id = address[1]
+        # The trailing terminator is stripped as a sample may not contain ";".
+        sample = frame[:-2].decode()
+        pimap_datum = create_pimap_sample(sample_type, patient_id,
+                                          device_id, sample, timestamp)
+        pimap_data.append((timestamp, pimap_datum))
+    # One put per received chunk instead of one per sample, so the pickle and
+    # pipe lock cost of the queue is amortized over the whole batch.
+    pimap_data_queue.put(pimap_data)
+
+def _sense_worker(sock, running, received_address_queue, max_buffer_size,
+                  pin_workers, worker_index):
+  """Worker process
+
+  Used internally to create TCP server processes. Each worker runs a selector
+  based event loop that multiplexes the listening socket and all of its
+  accepted connections, so one worker services many connections at once and
+  the number of simultaneous connections is not bounded by sense_workers.
+
+  Arguments:
+    sock: The listening TCP socket.
+    running: A shared boolean value that keeps the worker alive.
+    received_address_queue: The queue that (frames, address) pairs are put on.
+    max_buffer_size: The size of the receive buffer in bytes.
+    pin_workers: Whether the worker pins itself to one CPU.
+    worker_index: The index of the worker across all worker types.
+  """
+  _pin_worker(pin_workers, worker_index)
+  terminator = b";;"
+  # One receive buffer per worker, reused for every recv_into call, so the
+  # receive path allocates no fresh bytes object per recv.
+  receive_buffer = bytearray(max_buffer_size)
+  receive_view = memoryview(receive_buffer)
+  # A bounded pool of per-connection accumulation buffers, so the buffers of
+  # closed connections are reused by new ones instead of reallocated. The
+  # frames themselves must stay fresh objects as they are handed downstream.
+  buffer_pool = []
+  buffer_pool_size = 256
+  selector = selectors.DefaultSelector()
+  sock.setblocking(False)
+  # The listening socket is registered with data None; accepted connections
+  # carry their peer address and a per-connection receive bytearray.
+  selector.register(sock, selectors.EVENT_READ, None)
+  while running.value:
+    events = selector.select(timeout=0.1)
+    for (key, mask) in events:
+      if key.data is None:
+        # Accept every connection that is queued. Another worker may win the
+        # race for a pending connection, in which case accept raises
+        # BlockingIOError.
+        try:
+          while True:
+            (conn, address) = sock.accept()
+            # Disable Nagle's algorithm so small PIMAP samples are not held
+            # back waiting to coalesce, and match the enlarged kernel receive
+            # buffer.
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+            conn.setblocking(False)
+            received = buffer_pool.pop() if buffer_pool else bytearray()
+            selector.register(conn, selectors.EVENT_READ, (address, received))
+        except BlockingIOError: pass
+      else:
+        conn = key.fileobj
+        (address, received) = key.data
+        try:
+          received_size = conn.recv_into(receive_view)
+        except BlockingIOError:
+          continue
+        except OSError:
+          received_size = 0
+        if received_size == 0:
+          selector.unregister(conn)
+          conn.close()
+          if len(buffer_pool) < buffer_pool_size:
+            received.clear()
+            buffer_pool.append(received)
+          continue
+        # Received bytes accumulate in a bytearray and the terminator scan
+        # runs at C level on the raw bytes, so only completed frames are
+        # decoded. Growing a str per recv instead would decode partial frames
+        # and redo the concatenation work quadratically.
+        received.extend(receive_view[:received_size])
+        if terminator in received:
+          # Frames are cut with their terminator included and stay bytes until
+          # the pimap worker, which builds each datum string with a single
+          # decode instead of a decode plus a ";;" concatenation per datum.
+          processed = []
+          start = 0
+          index = received.find(terminator, start)
+          while index != -1:
+            processed.append(bytes(received[start:index + 2]))
+            start = index + 2
+            index = received.find(terminator, start)
+          del received[:start]
+          received_address_queue.put((processed, address))
+  selector.close()
+
 class PimapSenseTcp:
+  # The worker hot path is socket I/O and byte scanning, which release the GIL,
+  # so workers run as threads by default: an in-process queue.Queue then passes
+  # samples by reference instead of pickling each one through a pipe. Set this
+  # to True on the class to opt back into process workers should the
+  # per-datum validation ever become CPU-bound.
+  use_processes = False
+
   def __init__(self, host="localhost", port=31416, sample_type="tcp", ipv6=False,
-               sense_workers=3, pimap_workers=1, system_samples=False, app=""):
+               sense_workers=3, pimap_workers=1, system_samples=False, app="",
+               pin_workers=False):
     """Constructor for PIMAP Sense TCP
 
     Arguments:
@@ -34,6 +208,10 @@ class PimapSenseTcp:
       app (optional): A name of the application running, which is used to append
         to the name of they sample_type of system_samples,
         e.g. sample_type:"system_samples_app". Defaults to "".
+      pin_workers (optional): Whether each worker pins itself to one CPU, round
+        robin over the available CPUs. Pinning keeps a worker's caches warm and
+        avoids scheduler migrations, which helps on dedicated hosts but can hurt
+        on shared ones, so it is off by default. Defaults to False.
 
     Exceptions:
       socket.error:
@@ -51,12 +229,17 @@ class PimapSenseTcp:
     self.pimap_workers = int(pimap_workers)
     self.system_samples = bool(system_samples)
     self.app = str(app)
+    self.pin_workers = bool(pin_workers)
 
     # System Samples Setup
     self.sensed_data = 0
     self.system_samples_updated = time.time()
     self.system_samples_period = 1.0
-    self.latencies = []
+    # Latencies are kept as a running sum and count instead of an unbounded list
+    # that is only ever averaged, which also avoids a numpy round-trip per sense
+    # call just to subtract a scalar.
+    self.latency_sum = 0.0
+    self.latency_count = 0
 
     # Socket Setup
     if not self.ipv6:
@@ -69,127 +252,116 @@ class PimapSenseTcp:
                                     socket.SOCK_STREAM)
       self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
       address = addrinfo[0][4]
+    # Allow quick rebinds after a restart and give the kernel room to absorb
+    # bursts without dropping segments.
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
     self.socket.settimeout(1.0)
     try: self.socket.bind(address)
     except socket.error as e:
       self.socket.close()
       raise e
-    self.max_buffer_size = 4096
+    # 64 KiB pulls multiple TCP segments per recv syscall on a busy connection.
+    self.max_buffer_size = 65536
     self.host = self.socket.getsockname()[0]
     self.socket.listen(self.sense_workers)
 
     # Address Lookup Setup
     # Address lookup is by the tuple (patient_id, device_id) -> IP address.
-    # TODO: Under development! May be used in the future for PIMAP commands.
+    # TODO: Under development! May be used in the future for PIMAP commands. The
+    # workers no longer fill this in: with process workers the writes only ever
+    # landed in the worker's copy of this dict, and the hash and store per sample
+    # is not worth paying until the command feature exists.
     self.addresses_by_id = {}
 
-    # Multiprocess Setup
+    # Worker Setup
     self.running = multiprocessing.Value(ctypes.c_bool, True)
     self.running.value = True
-    self.pimap_data_queue = multiprocessing.Queue()
-    self.received_address_queue = multiprocessing.Queue()
+    if self.use_processes:
+      self.pimap_data_queue = multiprocessing.Queue()
+      self.received_address_queue = multiprocessing.Queue()
+      worker_class = multiprocessing.Process
+    else:
+      self.pimap_data_queue = queue.Queue()
+      self.received_address_queue = queue.Queue()
+      worker_class = threading.Thread
     self.sense_worker_processes = []
     for i in range(self.sense_workers):
-      worker_process = multiprocessing.Process(target=self._sense_worker, daemon=True)
+      worker_process = worker_class(
+        target=_sense_worker,
+        args=(self.socket, self.running, self.received_address_queue,
+              self.max_buffer_size, self.pin_workers, i), daemon=True)
       self.sense_worker_processes.append(worker_process)
       worker_process.start()
     self.pimap_worker_processes = []
     for i in range(self.pimap_workers):
-      worker_process = multiprocessing.Process(
-        target=self._create_pimap_data_and_add_to_queue, daemon=True)
+      worker_process = worker_class(
+        target=_create_pimap_data_and_add_to_queue,
+        args=(self.running, self.received_address_queue, self.pimap_data_queue,
+              self.sample_type, self.pin_workers, self.sense_workers + i),
+        daemon=True)
       self.pimap_worker_processes.append(worker_process)
       worker_process.start()
     time.sleep(0.1)
 
-  def _create_pimap_data_and_add_to_queue(self):
-    while self.running.value:
-      if not self.received_address_queue.empty():
-        (processed, address) = self.received_address_queue.get()
-        # If valid PIMAP sample/metric is received add it to the queue.
-        # Assume that if there is one valid PIMAP datum than all the data is PIMAP data.
-        if pu.validate_datum(processed[0] + ";;"):
-          pimap_data = list(map(lambda x: x + ";;", processed))
-          for pimap_datum in pimap_data:
-            patient_id = pu.get_patient_id(pimap_datum)
-            device_id = pu.get_device_id(pimap_datum)
-            self.pimap_data_queue.put(pimap_datum)
-            # TODO: Under development! May be used in the future for PIMAP commands.
-            self.addresses_by_id[(patient_id, device_id)] = address
-        else:
-          for datum in processed:
-            patient_id = address[0]
-            device_id = address[1]
-            sample = datum
-            pimap_datum = pu.create_pimap_sample(self.sample_type, patient_id,
-                                                 device_id, sample)
-            self.pimap_data_queue.put(pimap_datum)
-            # TODO: Under development! May be used in the future for PIMAP commands.
-            self.addresses_by_id[(patient_id, device_id)] = address
-
-  def _sense_worker(self):
-    """Worker process
-
-    Used internally to create TCP server processes.
-    """
-    terminator = ";;"
-    while self.running.value:
-      try:
-        (conn, address) = self.socket.accept()
-        with conn:
-          received_coded = conn.recv(self.max_buffer_size)
-          received = ""
-          while received_coded:
-            received += received_coded.decode()
-            if terminator in received:
-              received_split = received.split(terminator)
-              processed = received_split[:-1]
-              received = received_split[-1]
-              self.received_address_queue.put((processed, address))
-            received_coded = conn.recv(self.max_buffer_size)
-      except socket.timeout: continue
-
   def sense(self):
     """Core interaction of PIMAP Sense TCP.
 
     Returns:
       A list of PIMAP samples/metrics sensed since last call to sense().
     """
-    # Get all PIMAP data from the queue.
-    pimap_data = []
-    while not self.pimap_data_queue.empty():
-      pimap_data.append(self.pimap_data_queue.get())
+    # Get all PIMAP data from the queue. The queue holds one batch of
+    # (timestamp, datum) pairs per received chunk, parsed once in
+    # _create_pimap_data_and_add_to_queue, so nothing is reparsed here.
+    # empty() is documented as unreliable on multiprocessing queues, so the drain
+    # loops on get_nowait until the queue reports Empty itself.
+    decorated = []
+    try:
+      while True:
+        decorated.extend(self.pimap_data_queue.get_nowait())
+    except queue.Empty:
+      pass
 
-    # Sort the PIMAP data by timestamp. The PIMAP data can be out of order because we are
-    # using multiple processes to sense it.
-    pimap_data.sort(key=lambda x: float(pu.get_timestamp(x)))
+    # The clock is read once per call and reused for the latency subtraction, the
+    # system-sample period check, the throughput denominator, and the reset.
+    now = time.time()
+    pimap_data = []
+    # On an idle server there is nothing to sort or account, so the block below
+    # only runs when data was actually sensed.
+    if len(decorated) > 0:
+      # Sort the PIMAP data by timestamp. The PIMAP data can be out of order
+      # because we are using multiple processes to sense it.
+      decorated.sort(key=operator.itemgetter(0))
+      pimap_data = list(map(operator.itemgetter(1), decorated))
 
-    timestamps = (list(map(lambda x: float(pu.get_timestamp(x)), pimap_data)))
-    self.latencies.extend(time.time() - np.array(timestamps))
-    # Track the amount of sensed PIMAP data.
-    self.sensed_data += len(pimap_data)
+      self.latency_sum += sum(map(lambda x: now - x[0], decorated))
+      self.latency_count += len(decorated)
+      # Track the amount of sensed PIMAP data.
+      self.sensed_data += len(pimap_data)
 
     # If system_samples is True and a system_sample was not created within the last
     # system_samples period, create a system_sample.
     pimap_system_samples = []
     if (self.system_samples and
-        (time.time() - self.system_samples_updated > self.system_samples_period)):
+        (now - self.system_samples_updated > self.system_samples_period)):
       sample_type = "system_samples"
       if self.app != "":
         sample_type += "_" + self.app
       # Identify PIMAP Sense using the host and port.
       patient_id = "sense"
       device_id = (self.host, self.port)
-      sensed_data_per_s = self.sensed_data/(time.time() - self.system_samples_updated)
+      sensed_data_per_s = self.sensed_data/(now - self.system_samples_updated)
       sample = {"throughput":sensed_data_per_s}
-      if len(self.latencies) > 0:
-        sample["latency"] = np.mean(self.latencies)
+      if self.latency_count > 0:
+        sample["latency"] = self.latency_sum/self.latency_count
       system_sample = pu.create_pimap_sample(sample_type, patient_id, device_id, sample)
       pimap_system_samples.append(system_sample)
 
       # Reset system_samples variables.
-      self.system_samples_updated = time.time()
+      self.system_samples_updated = now
       self.sensed_data = 0
-      self.latencies = []
+      self.latency_sum = 0.0
+      self.latency_count = 0
 
     return pimap_data + pimap_system_samples
 
@@ -199,9 +371,16 @@ class PimapSenseTcp:
     Terminates server processes and closes the socket.
     """
     self.running.value = False
-    # Empty queues or processes won't join.
-    while not self.pimap_data_queue.empty(): self.pimap_data_queue.get()
-    while not self.received_address_queue.empty(): self.received_address_queue.get()
+    if self.use_processes:
+      # Empty queues or processes won't join.
+      try:
+        while True: self.pimap_data_queue.get_nowait()
+      except queue.Empty:
+        pass
+      try:
+        while True: self.received_address_queue.get_nowait()
+      except queue.Empty:
+        pass
     for worker_process in self.sense_worker_processes:
       worker_process.join()
     for worker_process in self.pimap_worker_processes:
@@ -9,14 +9,59 @@ Author: Sam Mansfield
 import ast
 import ctypes
 import multiprocessing
-import numpy as np
+import operator
+import os
+import queue
 import socket
+import threading
 import time
 from pimap import pimaputilities as pu
 
+def local_socket_path(port):
+  """Returns the filesystem path a local PimapSenseUdp binds for a port.
+
+  Arguments:
+    port: The port of the PIMAP Sense UDP server.
+
+  Returns:
+    The AF_UNIX socket path as a string.
+  """
+  return "/tmp/pimap." + str(int(port)) + ".sock"
+
+def local_sender(port):
+  """Creates a socket connected to a local-mode PimapSenseUdp.
+
+  Counterpart to PimapSenseUdp(local=True): datagrams sent on the returned
+  socket skip the IP/UDP stack entirely.
+
+  Arguments:
+    port: The port the local PimapSenseUdp was created with.
+
+  Returns:
+    A connected AF_UNIX datagram socket; send datagrams with send().
+
+  Exceptions:
+    socket.error:
+      If no local PimapSenseUdp is bound for the port.
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8*1024*1024)
+  try: sock.connect(local_socket_path(port))
+  except socket.error as e:
+    sock.close()
+    raise e
+  return sock
+
 class PimapSenseUdp:
+  # The workers spend their time blocked in recvfrom, which releases the GIL,
+  # so workers run as threads by default: an in-process queue.Queue then passes
+  # batches without pickling and construction skips the fork. Set use_processes
+  # to True on the class before construction to use processes instead.
+  use_processes = False
+
   def __init__(self, host="localhost", port=31415, sample_type="udp", ipv6=False,
-               workers=3, system_samples=False, app=""):
+               workers=3, system_samples=False, app="", pin_workers=False,
+               local=False):
     """Constructor for PIMAP Sense UDP
 
     Arguments:
@@ -31,6 +76,14 @@ class PimapSenseUdp:
       app (optional): A name of the application running, which is used to append
         to the name of they sample_type of system_samples,
         e.g. sample_type:"system_samples_app". Defaults to "".
+      pin_workers (optional): Whether each worker pins itself to one CPU, which
+        keeps its caches warm and stops the scheduler migrating it between
+        cores. Defaults to False.
+      local (optional): Whether to listen on an AF_UNIX datagram socket at
+        local_socket_path(port) instead of UDP. Local senders, created with
+        local_sender(port), then bypass the IP/UDP stack entirely, which is
+        faster when every component runs on one machine. host and ipv6 are
+        ignored in this mode. Defaults to False.
 
     Exceptions:
       socket.error:
@@ -47,15 +100,26 @@ class PimapSenseUdp:
     self.workers = int(workers)
     self.system_samples = bool(system_samples)
     self.app = str(app)
+    self.pin_workers = bool(pin_workers)
+    self.local = bool(local)
 
     # System Samples Setup
     self.sensed_data = 0
     self.system_samples_updated = time.time()
     self.system_samples_period = 1.0
-    self.latencies = []
+    # Latencies are kept as a running sum and count instead of an unbounded list
+    # that is only ever averaged, so memory stays flat between system samples.
+    self.latency_sum = 0.0
+    self.latency_count = 0
 
     # Socket Setup
-    if not self.ipv6:
+    if self.local:
+      self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      address = local_socket_path(self.port)
+      # A previous unclean shutdown leaves the path behind and bind would fail.
+      if os.path.exists(address):
+        os.remove(address)
+    elif not self.ipv6:
       addrinfo = socket.getaddrinfo(self.host, self.port, socket.AF_INET,
                                     socket.SOCK_DGRAM)
       self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -65,54 +129,117 @@ class PimapSenseUdp:
                                     socket.SOCK_DGRAM)
       self.socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
       address = addrinfo[0][4]
+    # Give the kernel room to absorb datagram bursts between recvfrom calls
+    # instead of dropping them. The kernel silently clamps the request to
+    # net.core.rmem_max, so the effective size is read back for callers to
+    # inspect; raising rmem_max is the fix if it comes back small.
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8*1024*1024)
+    self.receive_buffer_size = self.socket.getsockopt(socket.SOL_SOCKET,
+                                                      socket.SO_RCVBUF)
+    # With SO_REUSEPORT every worker binds its own socket to this address and
+    # the kernel hash-distributes datagrams between them, so the workers no
+    # longer contend on a single socket's receive lock. AF_UNIX paths cannot
+    # form a reuseport group, so in local mode the workers share this socket.
+    if not self.local and hasattr(socket, "SO_REUSEPORT"):
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     self.socket.settimeout(1.0)
     try: self.socket.bind(address)
     except socket.error as e:
       self.socket.close()
       raise e
+    self.address = self.socket.getsockname()
     self.max_buffer_size = 4096
 
     # Address Lookup Setup
     # Address lookup is by the tuple (patient_id, device_id) -> IP address.
-    # TODO: Under development! May be used in the future for PIMAP commands.
+    # TODO: Under development! May be used in the future for PIMAP commands. The
+    # workers no longer fill this in: the writes only ever landed in the worker
+    # process's copy of this dict, so the hash and store per datagram was pure
+    # waste. A Manager().dict() would be needed to share it.
     self.addresses_by_id = {}
 
     # Multiprocess Setup
     self.running = multiprocessing.Value(ctypes.c_bool, True)
-    self.pimap_data_queue = multiprocessing.Queue()
+    if self.use_processes:
+      self.pimap_data_queue = multiprocessing.Queue()
+      worker_class = multiprocessing.Process
+    else:
+      self.pimap_data_queue = queue.Queue()
+      worker_class = threading.Thread
     self.workers = self.workers
     self.worker_processes = []
     for i in range(self.workers):
-      worker_process = multiprocessing.Process(target=self._sense_worker, daemon=True)
+      worker_process = worker_class(target=self._sense_worker, args=(i,),
+                                    daemon=True)
       self.worker_processes.append(worker_process)
       worker_process.start()
 
-  def _sense_worker(self):
+  def _sense_worker(self, worker_index):
     """Worker process
 
-    Used internally to create UDP server processes.
+    Used internally to create UDP server processes. Datagrams are received in
+    batches: one blocking receive parks the worker until traffic arrives, then
+    zero-timeout receives drain whatever else the kernel already buffered, up
+    to batch_size. Python has no recvmmsg, but the batch still amortizes the
+    expensive part, as the whole batch goes onto the queue as a single put and
+    is pickled once instead of once per datagram. Switching the timeout costs
+    nothing here; the file descriptor stays non-blocking either way.
+
+    Arguments:
+      worker_index: The index of the worker, used for CPU pinning.
     """
+    if self.pin_workers and hasattr(os, "sched_setaffinity"):
+      os.sched_setaffinity(0, {worker_index % os.cpu_count()})
+    batch_size = 64
+    # Worker 0 reads the socket bound in __init__; the others each bind their
+    # own SO_REUSEPORT socket to the same address, so every member of the
+    # reuseport group has a reader and the kernel partitions traffic between
+    # them. Without SO_REUSEPORT all workers share the one socket as before.
+    if worker_index > 0 and not self.local and hasattr(socket, "SO_REUSEPORT"):
+      sock = socket.socket(self.socket.family, socket.SOCK_DGRAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8*1024*1024)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      sock.bind(self.address)
+    else:
+      sock = self.socket
     while self.running.value:
+      sock.settimeout(1.0)
+      # Without SO_REUSEPORT all workers share this socket object, so another
+      # worker entering its drain can flip the timeout to zero under us; the
+      # BlockingIOError that raises is treated like a timeout.
       try:
-        (received_coded, address) = self.socket.recvfrom(self.max_buffer_size)
+        received_batch = [sock.recvfrom(self.max_buffer_size)]
+      except (socket.timeout, BlockingIOError):
+        continue
+      sock.settimeout(0.0)
+      try:
+        while len(received_batch) < batch_size:
+          received_batch.append(sock.recvfrom(self.max_buffer_size))
+      except BlockingIOError:
+        pass
+
+      pimap_data = []
+      for (received_coded, address) in received_batch:
         received = received_coded.decode()
-        # If a valid PIMAP sample/metric is received add it to the queue.
+        # If a valid PIMAP sample/metric is received add it to the batch.
         if pu.validate_datum(received):
           pimap_datum = received
-          # Add lookup addresses of incoming PIMAP data.
-          patient_id = pu.get_patient_id(pimap_datum)
-          device_id = pu.get_device_id(pimap_datum)
-          # TODO: Under development! May be used in the future for PIMAP commands.
         else:
-          patient_id = address[0]
-          device_id = address[1]
+          # AF_UNIX senders are usually unbound and arrive with an empty
+          # address, so identify them by the server instead.
+          if isinstance(address, tuple):
+            patient_id = address[0]
+            device_id = address[1]
+          else:
+            patient_id = self.host
+            device_id = self.port
           sample = received
           pimap_datum = pu.create_pimap_sample(self.sample_type, patient_id, device_id,
                                                sample)
-        self.addresses_by_id[(patient_id, device_id)] = address
-        self.pimap_data_queue.put(pimap_datum)
-
-      except socket.timeout: continue
+        pimap_data.append(pimap_datum)
+      self.pimap_data_queue.put(pimap_data)
+    if sock is not self.socket:
+      sock.close()
 
   def sense(self):
     """Core interaction of PIMAP Sense UDP.
@@ -120,41 +247,57 @@ class PimapSenseUdp:
     Returns:
       A list of PIMAP samples/metrics sensed since last call to sense().
     """
-    # Get all PIMAP data from the queue.
+    # Get all PIMAP data from the queue. empty() is documented as unreliable on
+    # multiprocessing queues, so the drain loops on get_nowait until the queue
+    # reports Empty itself.
     pimap_data = []
-    while not self.pimap_data_queue.empty():
-      pimap_data.append(self.pimap_data_queue.get())
+    try:
+      while True:
+        pimap_data.extend(self.pimap_data_queue.get_nowait())
+    except queue.Empty:
+      pass
 
-    # Sort the PIMAP data by timestamp. The PIMAP data can be out of order because we are
-    # using multiple processes to sense it.
-    pimap_data.sort(key=lambda x: float(pu.get_timestamp(x)))
+    # The clock is read once per call and reused for the latency subtraction, the
+    # system-sample period check, the throughput denominator, and the reset.
+    now = time.time()
+    # On an idle server there is nothing to sort or account, so the block below
+    # only runs when data was actually sensed.
+    if len(pimap_data) > 0:
+      # Sort the PIMAP data by timestamp. The PIMAP data can be out of order
+      # because we are using multiple processes to sense it. Each timestamp is
+      # parsed once and kept next to its datum, so the sort key and the latency
+      # pass below do not re-scan the sample strings.
+      decorated = list(map(lambda x: (float(pu.get_timestamp(x)), x), pimap_data))
+      decorated.sort(key=operator.itemgetter(0))
+      pimap_data = list(map(operator.itemgetter(1), decorated))
 
-    # Track the amount of sensed PIMAP data.
-    self.sensed_data += len(pimap_data)
-    timestamps = list(map(lambda x: float(pu.get_timestamp(x)), pimap_data))
-    self.latencies.extend(time.time() - np.array(timestamps))
+      # Track the amount of sensed PIMAP data.
+      self.sensed_data += len(pimap_data)
+      self.latency_sum += sum(map(lambda x: now - x[0], decorated))
+      self.latency_count += len(decorated)
 
     # If system_samples is True and a system_sample was not created within the last
     # system_samples period, create a system_sample.
     pimap_system_samples = []
     if (self.system_samples and
-        (time.time() - self.system_samples_updated > self.system_samples_period)):
+        (now - self.system_samples_updated > self.system_samples_period)):
       sample_type = "system_samples"
       if self.app != "":
         sample_type += "_" + self.app
       # Identify PIMAP Sense using the host and port.
       patient_id = "sense"
       device_id = (self.host, self.port)
-      throughput = self.sensed_data/(time.time() - self.system_samples_updated)
+      throughput = self.sensed_data/(now - self.system_samples_updated)
       sample = {"throughput":throughput}
-      if len(self.latencies) > 0:
-        sample["latency"] = np.mean(self.latencies)
+      if self.latency_count > 0:
+        sample["latency"] = self.latency_sum/self.latency_count
       system_sample = pu.create_pimap_sample(sample_type, patient_id, device_id, sample)
       pimap_system_samples.append(system_sample)
 
       # Reset system_samples variables.
-      self.system_samples_updated = time.time()
-      self.latencies = []
+      self.system_samples_updated = now
+      self.latency_sum = 0.0
+      self.latency_count = 0
       self.sensed_data = 0
 
     return pimap_data + pimap_system_samples
@@ -165,9 +308,17 @@ class PimapSenseUdp:
     Terminates server processes and closes the socket.
     """
     self.running.value = False
+    if self.use_processes:
+      # Empty queues or processes won't join.
+      try:
+        while True: self.pimap_data_queue.get_nowait()
+      except queue.Empty:
+        pass
     for worker_process in self.worker_processes:
       worker_process.join()
     self.socket.close()
+    if self.local and os.path.exists(self.address):
+      os.remove(self.address)
 
 # Deprecated Methods: May be used in the future.
 #
@@ -8,9 +8,9 @@ License:
 Author: Sam Mansfield
 """
 import ast
+import collections
 import numpy as np
-import random
-import string
+import secrets
 import sys
 import time
 from confluent_kafka.admin import AdminClient, NewTopic
@@ -20,7 +20,8 @@ from confluent_kafka import KafkaException
 from pimap import pimaputilities as pu
 
 class PimapStoreKafka:
-  def __init__(self, host="localhost", port=9092, system_samples=False, app=""):
+  def __init__(self, host="localhost", port=9092, system_samples=False, app="",
+               timeout=0.5, validate=True, compression_type="lz4", group_id=None):
     """Constructor for PIMAP Store Kafka
 
     Arguments:
@@ -31,6 +32,21 @@ class PimapStoreKafka:
       app (optional): A name of the application running, which is used to append
         to the name of they sample_type of system_samples,
         e.g. sample_type:"system_samples_app". Defaults to "".
+      timeout (optional): How long retrieve blocks in seconds waiting for messages
+        when no timeout is passed to retrieve itself. A longer wait gives the
+        broker time to form full batches when the consumer is caught up.
+        Defaults to 0.5.
+      validate (optional): Whether store fully validates each datum before
+        producing. Set to False when the upstream component already produces
+        valid PIMAP, in which case store only performs a cheap prefix sanity
+        check. Defaults to True.
+      compression_type (optional): The producer compression codec. PIMAP datums
+        are redundant key:value text, which lz4 shrinks several-fold for little
+        CPU; Kafka compresses whole batches, so this pairs with the batching
+        settings below. Set to "none" to disable. Defaults to "lz4".
+      group_id (optional): The Kafka consumer group id. A stable id shares
+        offsets across restarts; the default random id starts from the earliest
+        offset every run. Defaults to None, which generates a random id.
 
     Exceptions:
       KafkaException:
@@ -39,22 +55,67 @@ class PimapStoreKafka:
     self.broker = str(host) + ":" + str(port)
     self.system_samples = bool(system_samples)
     self.app = str(app)
+    self.validate = bool(validate)
 
     self.system_samples_period = 1.0
-    self.stored_system_samples_updated = time.time()
-    self.retrieved_system_samples_updated = time.time()
+    # The system-sample clock check runs once per this many messages (or on an
+    # idle call) instead of once per call, so the bookkeeping cost stays flat as
+    # the message rate grows.
+    self.sample_check_every = 1024
+    self.stored_since_check = 0
+    self.retrieved_since_check = 0
+    # Throughput windows are intervals, so they use the monotonic clock, which
+    # is cheaper to read than time.time() and immune to clock adjustments.
+    self.stored_system_samples_updated = time.monotonic()
+    self.retrieved_system_samples_updated = time.monotonic()
     self.stored_latencies = []
     self.retrieved_latencies = []
 
     # No exception is raised when creating the admin so we call list_topics to see
-    # if the broker is valid.
+    # if the broker is valid. The metadata doubles as a client-side topic cache:
+    # retrieve answers for topics that do not exist without a subscribe and
+    # consume round trip, refreshing the cache at most every
+    # known_topics_period seconds.
     self.admin = AdminClient({"bootstrap.servers":self.broker})
-    self.admin.list_topics(timeout=10.0)
+    self.known_topics = set(self.admin.list_topics(timeout=10.0).topics)
+    self.known_topics_updated = time.monotonic()
+    self.known_topics_period = 5.0
 
-    self.consumer_dict = {}
+    # One consumer serves every subscribed topic; messages are demultiplexed
+    # into these per-topic queues by retrieve. A consumer per topic would pay a
+    # group-coordinator join per topic and poll each topic separately.
+    self.consumer = None
+    self.topic_queues = {}
+    # token_hex draws the random group_id in one call instead of a Python loop
+    # of random.choice.
+    if group_id != None: self.group_id = str(group_id)
+    else: self.group_id = secrets.token_hex(5)
+    # The broker is typically on localhost, so favor latency on the fetch
+    # path: disable Nagle on the client sockets, let fetch requests return as
+    # soon as any data exists instead of waiting out the 500ms default, and
+    # prefetch enough messages that consume serves from the local queue.
+    self.consumer_config = {"bootstrap.servers":self.broker,
+                            "group.id":self.group_id,
+                            "auto.offset.reset":"earliest",
+                            "socket.nagle.disable":True,
+                            "fetch.wait.max.ms":1,
+                            "fetch.min.bytes":1,
+                            "queued.min.messages":10000}
     self.num_messages = 100
-    self.timeout = 0.1
-    self.producer = Producer({"bootstrap.servers":self.broker})
+    self.timeout = float(timeout)
+    # Hysteresis state for the adaptive num_messages below: consecutive polls
+    # that agree on a direction, and the direction of the last poll.
+    self.stable_count = 0
+    self.last_direction = 0
+    # Drain delivery reports whenever the producer's internal queue grows past
+    # this many messages, so produce never hits the queue's hard limit.
+    self.producer_high_watermark = 50000
+    # Let librdkafka batch messages instead of sending each produce on its own:
+    # linger.ms waits briefly so produces are coalesced into larger requests.
+    self.producer = Producer({"bootstrap.servers":self.broker,
+                              "linger.ms":100,
+                              "batch.num.messages":10000,
+                              "compression.type":str(compression_type)})
     self.retrieved_data = 0
     self.stored_data = 0
     self.stored_topics = set()
@@ -74,53 +135,99 @@ class PimapStoreKafka:
     if not isinstance(pimap_data, list):
       raise TypeError("The argument pimap_data must be a list.")
 
-    valid_pimap_data = list(map(pu.validate_datum, pimap_data))
     # If pimap_data is an empty list we still want to continue, this way we can
-    # still return system_samples.
-    if not any(valid_pimap_data) and len(pimap_data) != 0:
-      raise ValueError("Invalid data in pimap_data.")
+    # still return system_samples. any() over a generator stops at the first valid
+    # datum, so the common all-valid batch validates one datum instead of building
+    # a list of results for the whole batch. When the caller is trusted a prefix
+    # check replaces the full field validation.
+    if len(pimap_data) != 0:
+      if self.validate:
+        if not any(map(pu.validate_datum, pimap_data)):
+          raise ValueError("Invalid data in pimap_data.")
+      elif not any(pimap_datum.startswith(("sample_type:", "metric_type:"))
+                   for pimap_datum in pimap_data):
+        raise ValueError("Invalid data in pimap_data.")
 
+    # Each datum is parsed once and the topic, key, and timestamp are taken from
+    # the parsed fields; the getters each scanned the datum again. Values and keys
+    # are encoded to bytes here so librdkafka does not re-encode them per message.
+    produce = self.producer.produce
+    poll = self.producer.poll
+    stored_topics = set()
+    timestamps = []
     for pimap_datum in pimap_data:
-      topic = pu.get_type(pimap_datum)
-      self.stored_topics.add(topic)
-      key = pu.get_patient_id(pimap_datum)
-      value = pimap_datum
+      parsed = pu._parse(pimap_datum)
+      if "sample_type" in parsed: topic = parsed["sample_type"]
+      else: topic = pu.get_type(pimap_datum)
+      stored_topics.add(topic)
+      key = parsed["patient_id"].encode()
+      value = pimap_datum.encode()
       try:
-        self.producer.produce(topic, value, key)
-      except BufferError as e:
-        self.producer.flush()
-        self.producer.produce(topic, value, key)
-    
-    # Filter out system_samples otherwise latency data also accounts for latency
-    # of system samples.
-    filtered_pimap_data = list(filter(
-      lambda x: pu.get_type(x).find("system_samples") == -1, pimap_data))
-    timestamps = list(map(lambda x: float(pu.get_timestamp(x)), filtered_pimap_data))
-    self.stored_latencies.extend(time.time() - np.array(timestamps))
+        produce(topic, value, key)
+      except BufferError:
+        # poll(0) drains delivery reports and frees queue slots without the
+        # synchronous wait of flush(), which stalls until every in-flight message
+        # is delivered and collapses throughput to single-message latency. flush()
+        # remains only as a last resort if the queue stays full.
+        for retry in range(10):
+          poll(0)
+          try:
+            produce(topic, value, key)
+            break
+          except BufferError:
+            time.sleep(0.001)
+        else:
+          self.producer.flush()
+          produce(topic, value, key)
+      # Drain delivery reports once the internal queue passes the high watermark,
+      # so the BufferError recovery above stays a rare path rather than the
+      # steady state.
+      if len(self.producer) > self.producer_high_watermark:
+        poll(0)
+      # Filter out system_samples otherwise latency data also accounts for latency
+      # of system samples.
+      if "system_samples" not in topic:
+        timestamps.append(float(parsed["timestamp"]))
+    self.stored_topics |= stored_topics
+    # Topics this client produces to exist from its point of view immediately.
+    self.known_topics |= stored_topics
+    # The wall clock is read once per call, only when there are latencies to
+    # account against the wall-clock timestamps in the data.
+    if len(timestamps) > 0:
+      self.stored_latencies.extend(time.time() - np.array(timestamps))
 
     pimap_system_samples = []
     if self.system_samples:
       self.stored_data += len(pimap_data)
-      if time.time() - self.stored_system_samples_updated > self.system_samples_period:
-        sample_type = "system_samples"
-        if self.app != "":
-          sample_type += "_" + self.app
-        patient_id = "store_store"
-        device_id = self.stored_topics
-        sample = {"throughput":(self.stored_data/
-                                (time.time() - self.stored_system_samples_updated)),
-                  "queue_length":len(self.producer)}
-        if len(self.stored_latencies) > 0:
-          sample["latency"] =  np.mean(self.stored_latencies)
-        pimap_system_samples.append(pu.create_pimap_sample(sample_type, patient_id,
-                                                           device_id, sample))
-        self.stored_system_samples_updated = time.time()
-        self.stored_data = 0
-        self.stored_latencies = []
+      self.stored_since_check += len(pimap_data)
+      # Read the monotonic clock for the throughput window every
+      # sample_check_every messages; idle calls check immediately so system
+      # samples still flow at low rates.
+      if (len(pimap_data) == 0 or
+          self.stored_since_check >= self.sample_check_every):
+        self.stored_since_check = 0
+        now_monotonic = time.monotonic()
+        if (now_monotonic - self.stored_system_samples_updated >
+            self.system_samples_period):
+          sample_type = "system_samples"
+          if self.app != "":
+            sample_type += "_" + self.app
+          patient_id = "store_store"
+          device_id = self.stored_topics
+          sample = {"throughput":(self.stored_data/
+                                  (now_monotonic - self.stored_system_samples_updated)),
+                    "queue_length":len(self.producer)}
+          if len(self.stored_latencies) > 0:
+            sample["latency"] =  np.mean(self.stored_latencies)
+          pimap_system_samples.append(pu.create_pimap_sample(sample_type, patient_id,
+                                                             device_id, sample))
+          self.stored_system_samples_updated = now_monotonic
+          self.stored_data = 0
+          self.stored_latencies = []
 
     return pimap_system_samples
 
-  def retrieve(self, sample_or_metric_type, patient_id=None):
+  def retrieve(self, sample_or_metric_type, patient_id=None, timeout=None):
     """Retrieves PIMAP data from Kafka. A core interaction of PIMAP Store Kafka.
 
     Arguments:
@@ -129,75 +236,130 @@ class PimapStoreKafka:
       patient_id (optional): An optional argument to filter retrieved data so that
         only data from one patient_id is returned. Defaults to None, which will
         not filter the retrieved data.
+      timeout (optional): How long to block in seconds waiting for data to arrive.
+        Blocking inside the Kafka client instead of sleeping between retrieve calls
+        wakes the caller as soon as data arrives. Defaults to None, which uses a
+        short internal timeout.
 
     Returns:
       A list of PIMAP data retrieved from Kafka.
     """
     topic = str(sample_or_metric_type)
-    if topic not in self.consumer_dict:
-      random_chars = [random.choice(string.ascii_letters) for i in range(10)]
-      group_id = "".join(random_chars)
-      self.consumer_dict[topic] = Consumer({"bootstrap.servers":self.broker,
-                                            "group.id":group_id,
-                                            "auto.offset.reset":"earliest"})
-      self.consumer_dict[topic].subscribe([topic])
-    kafka_messages = self.consumer_dict[topic].consume(num_messages=self.num_messages,
-                                                       timeout=self.timeout)
-    # If a timeout occured
+    if timeout is None: timeout = self.timeout
+    else: timeout = float(timeout)
+    # A topic that is neither subscribed nor known to the broker short-circuits
+    # to an empty result instead of subscribing and blocking in consume. The
+    # cache refresh bounds how long a freshly created topic goes unnoticed.
+    if topic not in self.topic_queues and topic not in self.known_topics:
+      now_monotonic = time.monotonic()
+      if now_monotonic - self.known_topics_updated < self.known_topics_period:
+        return []
+      self.known_topics = set(self.admin.list_topics(timeout=1.0).topics)
+      self.known_topics_updated = now_monotonic
+      if topic not in self.known_topics:
+        return []
+    if topic not in self.topic_queues:
+      self.topic_queues[topic] = collections.deque()
+      if self.consumer == None:
+        self.consumer = Consumer(self.consumer_config)
+      self.consumer.subscribe(list(self.topic_queues))
+    kafka_messages = self.consumer.consume(num_messages=self.num_messages,
+                                           timeout=timeout)
+    # Adapt num_messages with hysteresis: only resize after three consecutive
+    # polls agree on a direction, so one slow poll does not swing the batch size,
+    # and use gentle 1.5x/0.75x factors instead of doubling and halving.
     if len(kafka_messages) == 0:
-      self.num_messages = int(self.num_messages/2)
+      # A timeout occured.
+      self.stable_count = self.stable_count + 1 if self.last_direction == -1 else 1
+      self.last_direction = -1
+      if self.stable_count >= 3:
+        self.num_messages = int(self.num_messages*0.75)
     elif len(kafka_messages) >= self.num_messages:
-      self.num_messages = (self.num_messages*2)
+      self.stable_count = self.stable_count + 1 if self.last_direction == 1 else 1
+      self.last_direction = 1
+      if self.stable_count >= 3:
+        self.num_messages = int(self.num_messages*1.5)
+    else:
+      self.stable_count = 0
+      self.last_direction = 0
     if self.num_messages < 1: self.num_messages = 1
     elif self.num_messages > 1000000: self.num_messages = 1000000
    
+    # The consumed batch may carry messages for any subscribed topic, so
+    # demultiplex into the per-topic queues, then drain the requested topic's
+    # queue. Messages whose topic is unknown stay with the requested topic so
+    # the error handling below sees them.
+    topic_queue = self.topic_queues[topic]
+    for message in kafka_messages:
+      self.topic_queues.get(message.topic(), topic_queue).append(message)
+    topic_messages = list(topic_queue)
+    topic_queue.clear()
+
+    # Drop errored messages, filter by patient_id, and decode in one pass. The
+    # patient_id match runs on the raw bytes before decoding, so messages that
+    # will be filtered out are never decoded; data may not contain the keyword
+    # "patient_id", so the ";"-terminated needle only matches the field itself.
+    needle = None
+    if patient_id != None:
+      needle = f"patient_id:{patient_id};".encode()
     try:
-      kafka_messages_wo_errors = list(filter(lambda x: x.error() == None,
-                                             kafka_messages))
+      pimap_data = [message.value().decode() for message in topic_messages
+                    if message.error() == None and
+                    (needle == None or needle in message.value())]
     except KafkaException:
-      kafka_messages_wo_errors = []
-      for message in kafka_messages:
+      pimap_data = []
+      for message in topic_messages:
         try:
-          if message.error() == None: kafka_messages_wo_errors.append(message)
+          if (message.error() == None and
+              (needle == None or needle in message.value())):
+            pimap_data.append(message.value().decode())
         except KafkaException:
           print(message.error().code())
     except SystemError:
-      kafka_messages_wo_errors = []
-
-    pimap_data = list(map(lambda x: x.value().decode(), kafka_messages_wo_errors))
-    if patient_id != None:
-      pimap_data = list(filter(lambda x: pu.get_patient_id(x) == patient_id, pimap_data))
+      pimap_data = []
 
-    timestamps = list(map(lambda x: float(pu.get_timestamp(x)), pimap_data))
-    self.retrieved_latencies.extend(time.time() - np.array(timestamps))
+    # The wall clock is read once per call, only when there are latencies to
+    # account, as in store.
+    if len(pimap_data) > 0:
+      timestamps = list(map(lambda x: float(pu.get_timestamp(x)), pimap_data))
+      self.retrieved_latencies.extend(time.time() - np.array(timestamps))
 
     pimap_system_samples = []
     if self.system_samples:
       self.retrieved_data += len(pimap_data)
-      if (time.time() - self.retrieved_system_samples_updated >
-          self.system_samples_period):
-        sample_type = "system_samples"
-        if self.app != "":
-          sample_type += "_" + self.app
-        patient_id = "store_retrieve" 
-        device_id = self.consumer_dict.keys()
-        sample = {"throughput":(self.retrieved_data/
-                                (time.time() - self.retrieved_system_samples_updated)),
-                  "num_messages":self.num_messages,
-                  "messages":len(kafka_messages),
-                  "timeout":self.timeout}
-        if len(self.retrieved_latencies):
-          sample["latency"] = np.mean(self.retrieved_latencies)
-        pimap_system_samples.append(pu.create_pimap_sample(sample_type, patient_id,
-                                                           device_id, sample))
-        self.retrieved_system_samples_updated = time.time()
-        self.retrieved_data = 0
-        self.retrieved_latencies = []
+      self.retrieved_since_check += len(pimap_data)
+      # As in store, the monotonic clock check is amortized over
+      # sample_check_every messages, with idle calls checking immediately.
+      if (len(pimap_data) == 0 or
+          self.retrieved_since_check >= self.sample_check_every):
+        self.retrieved_since_check = 0
+        now_monotonic = time.monotonic()
+        if (now_monotonic - self.retrieved_system_samples_updated >
+            self.system_samples_period):
+          sample_type = "system_samples"
+          if self.app != "":
+            sample_type += "_" + self.app
+          patient_id = "store_retrieve"
+          device_id = self.topic_queues.keys()
+          sample = {"throughput":(self.retrieved_data/
+                                  (now_monotonic -
+                                   self.retrieved_system_samples_updated)),
+                    "num_messages":self.num_messages,
+                    "messages":len(kafka_messages),
+                    "timeout":self.timeout}
+          if len(self.retrieved_latencies):
+            sample["latency"] = np.mean(self.retrieved_latencies)
+          pimap_system_samples.append(pu.create_pimap_sample(sample_type, patient_id,
+                                                             device_id, sample))
+          self.retrieved_system_samples_updated = now_monotonic
+          self.retrieved_data = 0
+          self.retrieved_latencies = []
 
     return pimap_data + pimap_system_samples
 
   def close(self):
-    """Unsubscribes and closes all consumers."""
-    for consumer in self.consumer_dict.values():
-      consumer.unsubscribe()
-      consumer.close()
+    """Flushes the producer and unsubscribes and closes the consumer."""
+    self.producer.flush()
+    if self.consumer != None:
+      self.consumer.unsubscribe()
+      self.consumer.close()
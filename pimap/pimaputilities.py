@@ -6,11 +6,63 @@ License:
 Author: Sam Mansfield
 """
 import ast
+import functools
 import numpy as np
 import pickle
 import re
 import time
 
+# Matches every field of a PIMAP sample/metric in a single pass. The fields appear
+# in the order produced by create_pimap_sample/create_pimap_metric. Patterns are
+# compiled once at import; re.search with a string literal would look the pattern
+# up in the re module's internal cache on every call.
+_datum_regex = re.compile(
+  "(?:sample|metric)[-_]type:([^;]+);patient[-_]id:([^;]+);device[-_]id:([^;]+);"
+  "(?:sample|metric):([^;]+);timestamp:([^;]+);;")
+# The same pattern over bytes, for data that has not been decoded to a string.
+_datum_bytes_regex = re.compile(
+  b"(?:sample|metric)[-_]type:([^;]+);patient[-_]id:([^;]+);device[-_]id:([^;]+);"
+  b"(?:sample|metric):([^;]+);timestamp:([^;]+);;")
+
+@functools.lru_cache(maxsize=1024)
+def _parse(pimap_datum):
+  """Splits a PIMAP sample/metric into a dictionary of its fields.
+
+  A field may not contain a ";", so one split plus one partition per field parses
+  the whole datum; each getter previously ran its own regex scan over the full
+  string. The small cache means the repeated getter calls that components make on
+  the same datum reuse a single parse.
+
+  Arguments:
+    pimap_datum: A PIMAP sample/metric.
+
+  Returns:
+    Returns a dictionary of the fields present, all represented as strings.
+    Missing fields are simply absent; the getters raise on their behalf.
+  """
+  parsed = {}
+  parts = pimap_datum.split(";")
+  # Every field is ";"-terminated, so the element after the final ";" (empty for
+  # a well-formed datum, an unterminated fragment otherwise) is never a field.
+  for part in parts[:-1]:
+    (key, sep, value) = part.partition(":")
+    if not sep or not value:
+      continue
+    # Accept the legacy hyphenated form, e.g. "sample-type", like the old
+    # per-field regexes did.
+    if "-" in key:
+      key = key.replace("-", "_")
+    # Keep the first occurrence of a key, matching re.search semantics.
+    if key not in parsed:
+      parsed[key] = value
+  return parsed
+
+# One compiled alternation fuses the per-keyword substring scans in the create
+# functions into a single pass over the data. sample_type/metric_type are not
+# included as "sample"/"metric" are contained in them.
+_sample_forbidden_regex = re.compile("patient_id|device_id|sample|timestamp|;")
+_metric_forbidden_regex = re.compile("patient_id|device_id|metric|timestamp|;")
+
 def create_pimap_sample(sample_type, patient_id, device_id, sample, timestamp=None):
   """Creates a PIMAP sample.
   
@@ -49,20 +101,24 @@ def create_pimap_sample(sample_type, patient_id, device_id, sample, timestamp=No
     raise ValueError("did cannot contain a ':' or ';'.")
 
   s = str(sample)
-  # sample_type is not included as "sample" is in "sample_type".
-  special_keys = ["patient_id", "device_id", "sample", "timestamp", ";"]
-  if any(key in s for key in special_keys):
+  if _sample_forbidden_regex.search(s):
     raise ValueError("sample cannot contain any of the special keys:" +
-                     str(special_keys))
-
-  tstamp = str(time.time())
-  if timestamp != None: tstamp = str(timestamp)
-  try: tstamp_float = float(tstamp)
-  except ValueError:
-    raise ValueError("timestamp cannot be converted to a float.")
+                     str(["patient_id", "device_id", "sample", "timestamp", ";"]))
+
+  # The float round-trip only validates caller-supplied strings; numeric
+  # timestamps and the time.time() default cannot fail it.
+  if timestamp == None:
+    tstamp = str(time.time())
+  elif isinstance(timestamp, (int, float)):
+    tstamp = str(timestamp)
+  else:
+    tstamp = str(timestamp)
+    try: float(tstamp)
+    except ValueError:
+      raise ValueError("timestamp cannot be converted to a float.")
 
-  return ("sample_type:" + stype + ";patient_id:" + pid + ";device_id:" + did +
-          ";sample:" + s + ";timestamp:" + tstamp + ";;")
+  return (f"sample_type:{stype};patient_id:{pid};device_id:{did};"
+          f"sample:{s};timestamp:{tstamp};;")
 
 def create_pimap_metric(metric_type, pimap_datum, metric):
   """Creates a PIMAP metric.
@@ -88,19 +144,17 @@ def create_pimap_metric(metric_type, pimap_datum, metric):
   did = get_device_id(pimap_datum)
 
   m = str(metric)
-  # metric_type is not included as "metric" is in "metric_type".
-  special_keys = ["patient_id", "device_id", "metric", "timestamp", ";"]
-  if any(key in m for key in special_keys):
+  if _metric_forbidden_regex.search(m):
     raise ValueError("sample cannot contain any of the special keys:" +
-                     str(special_keys))
-  
+                     str(["patient_id", "device_id", "metric", "timestamp", ";"]))
+
   tstamp = get_timestamp(pimap_datum)
   try: tstamp_float = float(tstamp)
   except ValueError:
     raise ValueError("timestamp cannot be converted to a float.")
 
-  return ("metric_type:" + mtype + ";patient_id:" + pid + ";device_id:" + did +
-          ";metric:" + m + ";timestamp:" + tstamp + ";;")
+  return (f"metric_type:{mtype};patient_id:{pid};device_id:{did};"
+          f"metric:{m};timestamp:{tstamp};;")
 
 def get_sample_type(pimap_sample):
   """Gets the sample_type from a PIMAP sample.
@@ -114,9 +168,8 @@ def get_sample_type(pimap_sample):
   Exceptions:
     If a sample_type is not found a ValueError is thrown.
   """
-  match = re.search("sample[-_]type:([^;]+);", pimap_sample)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_sample)["sample_type"]
+  except KeyError:
     raise ValueError("PIMAP sample is malformed and does not include a sample_type.")
 
 def get_metric_type(pimap_metric):
@@ -131,9 +184,8 @@ def get_metric_type(pimap_metric):
   Exceptions:
     If a metric_type is not found a ValueError is thrown.
   """
-  match = re.search("metric[-_]type:([^;]+);", pimap_metric)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_metric)["metric_type"]
+  except KeyError:
     raise ValueError("PIMAP metric is malformed and does not include a metric_type.")
 
 def get_type(pimap_datum):
@@ -150,10 +202,9 @@ def get_type(pimap_datum):
     ValueError:
       If PIMAP datum is malformed, i.e. does not contain a sample_type or metric_type.
   """
-  sample_match = re.search("sample[-_]type:", pimap_datum)
-  if sample_match: return get_sample_type(pimap_datum)
-  metric_match = re.search("metric[-_]type:", pimap_datum)
-  if metric_match: return get_metric_type(pimap_datum)
+  parsed = _parse(pimap_datum)
+  if "sample_type" in parsed: return parsed["sample_type"]
+  if "metric_type" in parsed: return parsed["metric_type"]
   raise ValueError("PIMAP datum is malformed and does not include a sample_type or " +
                    "metric_type.")
 
@@ -170,9 +221,8 @@ def get_patient_id(pimap_datum):
     ValueError:
       If PIMAP datum is malformed, i.e. does not contain a patient_id.
   """
-  match = re.search("patient[-_]id:([^;]+);", pimap_datum)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_datum)["patient_id"]
+  except KeyError:
     raise ValueError("PIMAP sample is malformed and does not include a patient_id.")
 
 def get_device_id(pimap_datum):
@@ -188,9 +238,8 @@ def get_device_id(pimap_datum):
     ValueError:
       If PIMAP datum is malformed, i.e. does not contain a device_id.
   """
-  match = re.search("device[-_]id:([^;]+);", pimap_datum)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_datum)["device_id"]
+  except KeyError:
     raise ValueError("PIMAP sample is malformed and does not include a device_id.")
 
 def get_sample(pimap_sample):
@@ -205,9 +254,8 @@ def get_sample(pimap_sample):
   Exceptions:
     If a sample is not found a ValueError is thrown.
   """
-  match = re.search("sample:([^;]+);", pimap_sample)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_sample)["sample"]
+  except KeyError:
     raise ValueError("PIMAP sample is malformed and does not include a sample.")
 
 def get_metric(pimap_metric):
@@ -222,9 +270,8 @@ def get_metric(pimap_metric):
   Exceptions:
     If a metric is not found a ValueError is thrown.
   """
-  match = re.search("metric:([^;]+);", pimap_metric)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_metric)["metric"]
+  except KeyError:
     raise ValueError("PIMAP metric is malformed and does not include a metric.")
 
 def get_data(pimap_datum):
@@ -240,10 +287,9 @@ def get_data(pimap_datum):
     ValueError:
       If PIMAP datum is malformed, i.e. does not contain a sample or metric.
   """
-  sample_match = re.search("sample:", pimap_datum)
-  if sample_match: return get_sample(pimap_datum)
-  metric_match = re.search("metric:", pimap_datum)
-  if metric_match: return get_metric(pimap_datum)
+  parsed = _parse(pimap_datum)
+  if "sample" in parsed: return parsed["sample"]
+  if "metric" in parsed: return parsed["metric"]
   raise ValueError("PIMAP datum is malformed and does not include a sample or metric")
 
 def get_timestamp(pimap_datum):
@@ -259,11 +305,82 @@ def get_timestamp(pimap_datum):
     ValueError:
       If PIMAP datum is malformed, i.e. does not contain a timestamp.
   """
-  match = re.search("timestamp:([^;]+);", pimap_datum)
-  if match: return match.group(1)
-  else:
+  try: return _parse(pimap_datum)["timestamp"]
+  except KeyError:
     raise ValueError("PIMAP datum is malformed and does not include a timestamp.")
 
+def partition_by_type(pimap_data):
+  """Partitions PIMAP data into lists keyed by sample_type/metric_type.
+
+  One pass over the data replaces a filter pass, each with its own parse per
+  datum, per type of interest.
+
+  Arguments:
+    pimap_data: A list of PIMAP data.
+
+  Returns:
+    Returns a dictionary mapping each type to the list of PIMAP data of that
+    type, preserving the input order within each list.
+
+  Exceptions:
+    ValueError:
+      If pimap_data contains a PIMAP datum without a type.
+  """
+  partitioned = {}
+  for pimap_datum in pimap_data:
+    partitioned.setdefault(get_type(pimap_datum), []).append(pimap_datum)
+  return partitioned
+
+def parse_datum(pimap_datum):
+  """Parses all fields of a PIMAP sample/metric in a single pass.
+
+  This is much faster than calling the individual getters when more than one field
+  is needed, as each getter scans the whole PIMAP datum.
+
+  Arguments:
+    pimap_datum: A PIMAP sample/metric.
+
+  Returns:
+    Returns a dictionary with the keys "type", "patient_id", "device_id", "data",
+    and "timestamp", all represented as strings.
+
+  Exceptions:
+    ValueError:
+      If PIMAP datum is malformed, i.e. does not contain every field.
+  """
+  match = _datum_regex.search(pimap_datum)
+  if not match:
+    raise ValueError("PIMAP datum is malformed and does not include every field.")
+  return {"type":match.group(1), "patient_id":match.group(2),
+          "device_id":match.group(3), "data":match.group(4),
+          "timestamp":match.group(5)}
+
+def parse_datum_bytes(pimap_datum):
+  """Parses all fields of a bytes PIMAP sample/metric in a single pass.
+
+  The bytes counterpart of parse_datum for data that arrives encoded, e.g. from a
+  socket or a Kafka message value. The field values are returned as bytes without
+  ever decoding the datum, so a large payload such as a pickled array is not
+  round-tripped through a string on its way to the consumer.
+
+  Arguments:
+    pimap_datum: A PIMAP sample/metric as bytes.
+
+  Returns:
+    Returns a dictionary with the keys "type", "patient_id", "device_id", "data",
+    and "timestamp", all represented as bytes.
+
+  Exceptions:
+    ValueError:
+      If PIMAP datum is malformed, i.e. does not contain every field.
+  """
+  match = _datum_bytes_regex.search(pimap_datum)
+  if not match:
+    raise ValueError("PIMAP datum is malformed and does not include every field.")
+  return {"type":match.group(1), "patient_id":match.group(2),
+          "device_id":match.group(3), "data":match.group(4),
+          "timestamp":match.group(5)}
+
 def validate_datum(possible_pimap_datum):
   """Validates a PIMAP sample/metric.
   
@@ -274,15 +391,43 @@ def validate_datum(possible_pimap_datum):
     True if possible_pimap_datum is a PIMAP sample/metric.
     False otherwise.
   """
-  try:
-    typ = get_type(possible_pimap_datum)
-    pid = get_patient_id(possible_pimap_datum)
-    did = get_device_id(possible_pimap_datum)
-    d = get_data(possible_pimap_datum)
-    tstamp = get_timestamp(possible_pimap_datum)
-  except ValueError:
+  s = possible_pimap_datum
+  # Every PIMAP datum starts with its type field and ends with the ";;"
+  # sentinel, so two substring compares dismiss arbitrary strings before any
+  # parsing happens.
+  if not s.endswith(";;"):
+    return False
+  # Fast path: create_pimap_sample/create_pimap_metric emit their fields in a
+  # fixed order, so ordered find probes with a running offset make one
+  # allocation-free pass. Each probe also checks that its value is non-empty.
+  if s.startswith("sample_type:"):
+    data_probe = ";sample:"
+  elif s.startswith("metric_type:"):
+    data_probe = ";metric:"
+  elif s.startswith("sample-type:") or s.startswith("metric-type:"):
+    # The legacy hyphenated form takes the parsing path below.
+    data_probe = None
+  else:
     return False
-  return True
+  if data_probe != None and s[12] != ";":
+    find = s.find
+    start = 12
+    for (probe, probe_size) in ((";patient_id:", 12), (";device_id:", 11),
+                                (data_probe, len(data_probe)), (";timestamp:", 11)):
+      index = find(probe, start)
+      if index < 0 or s[index + probe_size] == ";":
+        start = -1
+        break
+      start = index + probe_size
+    if start > 0:
+      return True
+  # Slow path: the legacy hyphenated form and fields that follow the type in
+  # an unexpected order.
+  parsed = _parse(s)
+  return (("sample_type" in parsed or "metric_type" in parsed) and
+          ("sample" in parsed or "metric" in parsed) and
+          "patient_id" in parsed and "device_id" in parsed and
+          "timestamp" in parsed)
 
 # Deprecated methods: May be used in the future.
 #
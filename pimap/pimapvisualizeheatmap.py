@@ -6,12 +6,37 @@ map.
 License:-
 Authors: Eric Vin, Sam Mansfield
 """
+import base64
 import pickle
+import struct
 import numpy as np
 import time
 from matplotlib import pyplot as plt
 from pimap import pimaputilities as pu
 
+# dtype codes of the binary heatmap framing; the inverse of the table in
+# pimapanalyzeheatmap.
+_heatmap_dtypes = {1:np.float64, 2:np.float32, 3:np.float16, 4:np.uint8}
+
+def unpack_heatmap(payload):
+  """Unpacks a heatmap payload produced by pimapanalyzeheatmap.pack_heatmap.
+
+  Binary frames are read with a single np.frombuffer view over the payload, no
+  object reconstruction. Legacy pickled heatmaps are recognized by their leading
+  0x80 byte and unpickled as before.
+
+  Arguments:
+    payload: The decoded heatmap payload as bytes.
+
+  Returns:
+    Returns the heatmap as a 2D array.
+  """
+  if payload[:1] == b"\x80":
+    return pickle.loads(payload)
+  (dtype_code, height, width) = struct.unpack_from("<BHH", payload)
+  return np.frombuffer(payload, dtype=_heatmap_dtypes[dtype_code],
+                       offset=5).reshape(height, width)
+
 class PimapVisualizeHeatmap:
   """ Visualizes a heatmap using matplotlib. """
   def __init__(self, min_value=0.0, max_value=1e6):
@@ -19,6 +44,9 @@ class PimapVisualizeHeatmap:
     self.min_value = float(min_value)
     self.max_value = float(max_value)
     self.heat_map = [[self.min_value, self.max_value]]
+    # The shape is cached so each frame compares tuples instead of going through
+    # the np.shape wrapper twice.
+    self.heat_map_shape = np.shape(self.heat_map)
     self.im = self.axes.imshow(self.heat_map, origin="lower")
     self.colorbar = self.figure.colorbar(self.im)
     self.text = self.figure.text(0, 0, "")
@@ -33,13 +61,27 @@ class PimapVisualizeHeatmap:
       return
 
     pimap_metric = pimap_metrics[-1]
-    timestamp = float(pu.get_timestamp(pimap_metric))
+    # SentinelHeatmap metrics carry a base64-encoded binary heatmap frame (or a
+    # legacy pickle). A metric may also arrive as undecoded bytes, in which case
+    # the payload goes straight to b64decode without a round-trip through a
+    # string.
+    if isinstance(pimap_metric, bytes):
+      parsed = pu.parse_datum_bytes(pimap_metric)
+      timestamp = float(parsed["timestamp"].decode())
+    else:
+      parsed = pu.parse_datum(pimap_metric)
+      timestamp = float(parsed["timestamp"])
     self.text.set_text(time.asctime(time.localtime(timestamp)))
-    data = pickle.loads(pu.get_data(pimap_metric).encode())
+    # asarray is a no-copy pass-through for the arrays unpack_heatmap returns
+    # and only materializes legacy list payloads.
+    data = np.asarray(unpack_heatmap(base64.b64decode(parsed["data"])))
 
-    if np.shape(data) != np.shape(self.heat_map):
+    if data.shape != self.heat_map_shape:
       self.im = self.axes.imshow(data, origin="lower")
-    else:
+      self.heat_map_shape = data.shape
+    elif not np.array_equal(data, self.heat_map):
+      # An unchanged frame skips set_data entirely, so nothing is marked stale
+      # and no redraw is scheduled.
       self.im.set_data(data)
     self.heat_map = data
 
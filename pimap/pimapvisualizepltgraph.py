@@ -7,8 +7,13 @@ License:
 Author: Sam Mansfield
 """
 import ast
+import ctypes
 import datetime
+import functools
+import matplotlib
+import multiprocessing
 import numpy as np
+import queue
 import pickle
 import re
 import sys
@@ -18,8 +23,162 @@ from matplotlib import dates as mdates
 from matplotlib import pyplot as plt
 from pimap import pimaputilities as pu
 
+@functools.lru_cache(maxsize=4096)
+def _parse_data(data_string):
+  """Parses a data field string into a dict, memoized on the string.
+
+  Replayed and multi-subscriber streams re-see the same samples; since the
+  strings are immutable the parsed dict is simply reused instead of running
+  literal_eval again.
+
+  Arguments:
+    data_string: The data field of a PIMAP datum.
+
+  Returns:
+    The parsed data dict.
+  """
+  return ast.literal_eval(data_string)
+
+# A NaT/NaN point between two line segments of a merged Line2D renders as a
+# gap, which is how one artist draws every line of a style.
+_date_separator = np.array([np.datetime64("NaT", "ms")])
+_value_separator = np.array([np.nan])
+
+def minmax_indices(data, n_out):
+  """Preselects the index of the minimum and maximum of equal-width buckets.
+
+  Used ahead of lttb_indices so the downsampled line keeps the envelope of the
+  raw data: a plain stride slice can step over every spike.
+
+  Arguments:
+    data: A 1D array of values.
+    n_out: The approximate number of indices to select.
+
+  Returns:
+    A sorted array of unique indices into data.
+  """
+  size = len(data)
+  if n_out >= size:
+    return np.arange(size)
+  buckets = max(n_out//2, 1)
+  # Equal-width buckets reshape into a 2D array, so every bucket's argmin and
+  # argmax come out of two C-level reductions instead of a Python loop per
+  # bucket. The remainder that does not fill a bucket forms one tail bucket.
+  width = size//buckets
+  trimmed = buckets*width
+  shaped = data[:trimmed].reshape(buckets, width)
+  offsets = np.arange(buckets, dtype=np.intp)*width
+  indices = np.concatenate((offsets + shaped.argmin(axis=1),
+                            offsets + shaped.argmax(axis=1)))
+  if trimmed < size:
+    tail = data[trimmed:]
+    tail_indices = np.array((trimmed + np.argmin(tail), trimmed + np.argmax(tail)),
+                            dtype=np.intp)
+    indices = np.concatenate((indices, tail_indices))
+  return np.unique(indices)
+
+def lttb_indices(xs, ys, n_out):
+  """Selects n_out indices with largest-triangle-three-buckets downsampling.
+
+  The first and last points are always kept. The interior is cut into equal
+  buckets and from each bucket the point forming the largest triangle with the
+  previously selected point and the average of the next bucket wins, which
+  preserves the visually dominant points of the line.
+
+  Arguments:
+    xs: A 1D float array of x values.
+    ys: A 1D float array of y values.
+    n_out: The number of indices to select.
+
+  Returns:
+    A sorted array of n_out indices into xs/ys.
+  """
+  size = len(xs)
+  if n_out >= size or n_out < 3:
+    return np.arange(size)
+  boundaries = np.linspace(1, size - 1, n_out - 1).astype(np.intp)
+  indices = np.empty(n_out, dtype=np.intp)
+  indices[0] = 0
+  indices[n_out - 1] = size - 1
+  selected = 0
+  for i in range(n_out - 2):
+    start = boundaries[i]
+    end = boundaries[i + 1]
+    if end <= start:
+      selected = start
+      indices[i + 1] = selected
+      continue
+    if i < n_out - 3:
+      next_end = boundaries[i + 2]
+    else:
+      next_end = size
+    next_end = max(next_end, end + 1)
+    average_x = xs[end:next_end].mean()
+    average_y = ys[end:next_end].mean()
+    areas = np.abs((xs[selected] - average_x)*(ys[start:end] - ys[selected]) -
+                   (xs[selected] - xs[start:end])*(average_y - ys[selected]))
+    selected = start + np.argmax(areas)
+    indices[i + 1] = selected
+  return indices
+
+def downsample(times, data, n_out):
+  """Downsamples one line to about n_out points for plotting.
+
+  A MinMax preselection to 4*n_out points keeps the envelope, then LTTB picks
+  the n_out visually dominant points. Unlike the stride slice this replaces,
+  spikes survive downsampling, so the display limit does not have to stay large
+  for the graph to look right.
+
+  Arguments:
+    times: A 1D float array of epoch seconds, sorted ascending.
+    data: A 1D float array of values aligned with times.
+    n_out: The number of points to keep, or -1 for no limit.
+
+  Returns:
+    A (times, data) tuple of the downsampled line.
+  """
+  if n_out == -1 or n_out < 3 or len(data) <= n_out:
+    return (times, data)
+  xs = np.asarray(times, dtype=np.float64)
+  ys = np.asarray(data, dtype=np.float64)
+  preselected = minmax_indices(ys, 4*n_out)
+  selected = preselected[lttb_indices(xs[preselected], ys[preselected], n_out)]
+  return (xs[selected], ys[selected])
+
+def _visualize_worker(keys, system_samples, app, backend, line_capacity,
+                      running, pimap_data_queue, system_samples_queue):
+  """Worker that runs a PimapVisualizePltGraph in its own process.
+
+  The graph is constructed inside the worker, so the figure and all matplotlib
+  state live in this process and the parent never blocks on a draw.
+
+  Arguments:
+    keys: The keys argument of PimapVisualizePltGraph.
+    system_samples: The system_samples argument of PimapVisualizePltGraph.
+    app: The app argument of PimapVisualizePltGraph.
+    backend: The backend argument of PimapVisualizePltGraph.
+    line_capacity: The line_capacity argument of PimapVisualizePltGraph.
+    running: A shared boolean value that keeps the worker alive.
+    pimap_data_queue: The queue batches of PIMAP data arrive on.
+    system_samples_queue: The queue produced system samples are put on.
+  """
+  graph = PimapVisualizePltGraph(keys, system_samples=system_samples, app=app,
+                                 backend=backend, line_capacity=line_capacity)
+  while running.value:
+    # A blocking get parks this worker while no data is pending; an empty
+    # batch still ticks the refresh and system sample logic.
+    try:
+      pimap_data = pimap_data_queue.get(timeout=0.1)
+    except queue.Empty:
+      pimap_data = []
+    pimap_system_samples = graph.visualize(pimap_data)
+    if len(pimap_system_samples) > 0:
+      system_samples_queue.put(pimap_system_samples)
+  graph.close()
+
 class PimapVisualizePltGraph:
-  def __init__(self, keys, system_samples=False, app=""):
+  def __init__(self, keys, system_samples=False, app="", backend=None,
+               line_capacity=65536):
     """Constructor for PIMAP Visualize Plt Graph
 
     Arguments:
@@ -31,6 +190,14 @@ class PimapVisualizePltGraph:
       app (optional): A name of the application running, which is used to append
         to the name of they sample_type of system_samples,
         e.g. sample_type:"system_samples_app". Defaults to "".
+      backend (optional): A matplotlib backend name to select before the figure
+        is created, e.g. "agg". With the non-interactive "agg" backend no
+        window is opened and each refresh renders into rgba_buffer, which a
+        client can stream or write to a file. Defaults to None, which keeps
+        whatever backend matplotlib already selected.
+      line_capacity (optional): The number of points retained per line. Older
+        points are overwritten once a line's ring buffers fill, which keeps
+        memory and refresh time bounded on long runs. Defaults to 65536.
 
     Exceptions:
       TypeError:
@@ -39,12 +206,24 @@ class PimapVisualizePltGraph:
     if not isinstance(keys, list):
       raise TypeError("The argument keys must be a list")
 
+    if backend != None:
+      matplotlib.use(str(backend))
+    self.interactive = matplotlib.get_backend().lower() != "agg"
+    self.rgba_buffer = None
+
     self.keys = keys
     self.system_samples = bool(system_samples)
     self.app = str(app)
 
+    # Fast-path extractors for the data field: one compiled regex per key
+    # pulls a plain numeric value straight out of the dict's string form.
+    self.key_regexes = {}
+    for key in self.keys:
+      self.key_regexes[key] = re.compile(
+          "['\"]" + re.escape(str(key)) + "['\"]\\s*:\\s*([-+0-9.eE]+)\\s*[,}]")
+
     # System Samples Setup
-    self.system_samples_updated = time.time()
+    self.system_samples_updated = time.monotonic()
     self.system_samples_period = 1.0
     self.latencies = []
     self.visualized_data = 0
@@ -57,9 +236,27 @@ class PimapVisualizePltGraph:
 
     self.units = None
     self.title = None
-    self.plot_dates = defaultdict(list)
-    self.plot_data = defaultdict(list)
+    # Each line stores its points in preallocated ring buffers of epoch seconds
+    # and values; see append_line_points. The capacity bounds memory on long
+    # runs, after which the oldest points are overwritten.
+    self.line_capacity = int(line_capacity)
+    self.line_buffers = {}
+    # Line ids sharing a style are merged into a single Line2D with NaN/NaT
+    # separators between the segments, so matplotlib draws one artist per
+    # style instead of one per patient/device pair. lines maps a style to its
+    # merged artist; the legend gets one proxy artist per style.
     self.lines = {}
+    self.color_cycle = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    self.line_styles = {}
+    self.style_groups = defaultdict(list)
+    self.line_plot_points = {}
+    self.legend_proxies = {}
+    # The rendered axes background without the lines, used for blitting. The
+    # lines are animated artists, so a full draw renders everything but them,
+    # and a refresh restores this background and redraws only the line artists.
+    # Captured lazily on the first refresh and recaptured whenever the axis
+    # limits or the set of lines change.
+    self.background = None
     self.total_data = 0
     self.figure, self.axes = plt.subplots()
 
@@ -75,12 +272,24 @@ class PimapVisualizePltGraph:
     self.aggregation_period = 0.2*self.refresh_period
     self.process_period = 0.4*self.refresh_period
     self.plot_period = 0.4*self.refresh_period
-    self.time_plotted = time.time()
-
-    # Display empty figure
+    self.time_plotted = time.monotonic()
+
+    # The limits are steered by exponential moving averages of the measured
+    # process and plot times: each refresh scales a limit by at most 2x toward
+    # its period target, so one slow frame nudges the limit instead of halving
+    # it and the controller settles near the optimum.
+    self.process_time_ema = self.process_period
+    self.plot_time_ema = self.plot_period
+    self.ema_weight = 0.2
+    self.min_limit = 16
+    self.max_limit = 8192
+
+    # Display empty figure. flush_events processes pending GUI events without
+    # the forced 1ms wait of start_event_loop.
     self.figure.canvas.draw_idle()
-    plt.show(block=False)
-    self.figure.canvas.start_event_loop(0.001)
+    if self.interactive:
+      plt.show(block=False)
+      self.figure.canvas.flush_events()
 
   def visualize(self, pimap_data):
     """Core interaction of PIMAP Visualize Plt Graph.
@@ -105,36 +314,76 @@ class PimapVisualizePltGraph:
       raise ValueError("Invalid data in pimap_data.")
 
     self.aggregation_buffer.extend(pimap_data)
-    pimap_system_samples = [] 
+    pimap_system_samples = []
 
+    # All interval timers read the monotonic clock once per checkpoint, which
+    # keeps the deltas consistent with each other and immune to wall-clock
+    # jumps. The wall clock is only read for the latencies and the timestamps
+    # emitted in system samples.
+    monotonic_entry = time.monotonic()
     if self.state == "aggregate":
-      if ((time.time() - self.time_plotted > self.aggregation_period) or
+      if ((monotonic_entry - self.time_plotted > self.aggregation_period) or
          (len(self.aggregation_buffer) > self.aggregation_limit)):
         self.state = "process_and_plot"
     if self.state == "process_and_plot":
-      start_time_to_process = time.time()
       data_processed = 0
+      lines_added = False
+      styles_updated = set()
+      # Each datum is parsed exactly once up front: one pass for the PIMAP fields
+      # and one literal_eval for the data dict. The per-key loop previously
+      # re-ran literal_eval per key in its filter and once more to build the
+      # values, plus a getter scan per field.
+      wall_entry = time.time()
+      parsed_buffer = list(map(pu.parse_datum, self.aggregation_buffer))
+      # The data field of nearly every sample is a flat dict of numeric
+      # values; the per-key regexes pull a value straight out of the string
+      # form, skipping literal_eval's full parse and dict build. A sample only
+      # falls back to literal_eval when its key is present with a value that
+      # is not a plain number, and the parsed dict is then reused across keys.
+      data_strings = list(map(lambda x: x["data"], parsed_buffer))
+      data_dicts = [None]*len(data_strings)
+      # The fields are pulled into arrays once per buffer rather than once per
+      # key, and the timestamp strings convert to float64 in a single C-level
+      # pass instead of a Python float() per sample per key. The per-key loop
+      # below then only fancy-indexes these arrays.
+      buffer_types = np.array(list(map(lambda x: x["type"], parsed_buffer)))
+      buffer_patient_ids = np.array(list(map(lambda x: x["patient_id"],
+                                             parsed_buffer)))
+      buffer_device_ids = np.array(list(map(lambda x: x["device_id"],
+                                            parsed_buffer)))
+      buffer_timestamps = np.array(list(map(lambda x: x["timestamp"],
+                                            parsed_buffer)),
+                                   dtype=np.float64).round(3)
       for key in self.keys:
-        filtered_pimap_data = list(filter(lambda x: key in ast.literal_eval(
-                                                              pu.get_data(x)),
-                                          self.aggregation_buffer))
-        if len(filtered_pimap_data) == 0:
+        search = self.key_regexes[key].search
+        quoted_key = "'" + key + "'"
+        filtered_index_list = []
+        values = []
+        for (i, data_string) in enumerate(data_strings):
+          match = search(data_string)
+          if match != None:
+            filtered_index_list.append(i)
+            values.append(float(match.group(1)))
+          elif quoted_key in data_string:
+            if data_dicts[i] == None:
+              data_dicts[i] = _parse_data(data_string)
+            if key in data_dicts[i]:
+              filtered_index_list.append(i)
+              values.append(float(data_dicts[i][key]))
+        if len(filtered_index_list) == 0:
           continue
+        filtered_indices = np.array(filtered_index_list, dtype=np.intp)
+
+        self.total_data += len(filtered_indices)
+        data_processed += len(filtered_indices)
+        self.visualized_data += len(filtered_indices)
 
-        self.total_data += len(filtered_pimap_data)
-        data_processed += len(filtered_pimap_data)
-        self.visualized_data += len(filtered_pimap_data)
-
-        types = list(map(pu.get_type, filtered_pimap_data))
-        patient_ids = list(map(pu.get_patient_id, filtered_pimap_data))
-        device_ids = list(map(pu.get_device_id, filtered_pimap_data))
-        timestamps = list(map(lambda x: round(float(pu.get_timestamp(x)), 3),
-                              filtered_pimap_data))
-        self.latencies.extend(time.time() - np.array(timestamps))
-        dates = list(map(lambda x: datetime.datetime.fromtimestamp(x), timestamps))
-        data_dicts = list(map(lambda x: ast.literal_eval(pu.get_data(x)),
-                              filtered_pimap_data))
-        data = list(map(lambda x: x[key], data_dicts))
+        types = buffer_types[filtered_indices]
+        patient_ids = buffer_patient_ids[filtered_indices]
+        device_ids = buffer_device_ids[filtered_indices]
+        timestamps = buffer_timestamps[filtered_indices]
+        self.latencies.extend(wall_entry - timestamps)
+        data = np.array(values, dtype=np.float64)
 
         # Deprecated, but may be used in the future. This is on way to use units in
         # the graph, but is kind of hacky.
@@ -143,73 +392,134 @@ class PimapVisualizePltGraph:
         #    self.units = test_dict_for_units[key + "_units"]
         #    self.axes.set_ylabel(self.units)
 
-        lines_updated = set()
-        for pid, did, date, data, typ in zip(patient_ids, device_ids, dates, data,
-                                                                                  types):
-          line_id = ("pid:" + pid + ", did:" + did + ", data:" + key + ", type:" + typ)
-          lines_updated.add(line_id)
-          self.plot_dates[line_id].append(date)
-          self.plot_data[line_id].append(data)
-
-        down_sample = 1
-        if (self.total_data >= self.display_limit and self.display_limit != -1):
-          down_sample = int(self.total_data/self.display_limit)
-
-        for line_id in lines_updated:
-          if line_id in self.lines:
-            self.lines[line_id].set_data(self.plot_dates[line_id][::down_sample],
-                                         self.plot_data[line_id][::down_sample])
-          else:
-            self.lines[line_id], = self.axes.plot(
-                                            self.plot_dates[line_id][::down_sample],
-                                            self.plot_data[line_id][::down_sample],
-                                            label=line_id)
-
-      time_to_process = time.time() - start_time_to_process
-      if time_to_process > self.process_period and data_processed > 0:
-        self.aggregation_limit /= 2
-      elif len(self.aggregation_buffer) >= self.aggregation_limit:
-        self.aggregation_limit += len(self.aggregation_buffer)
+        # Points are grouped per line in C: the line id strings are composed
+        # with np.char.add, np.unique hands back an inverse index per sample,
+        # and a stable argsort over the inverse lays out each line's points
+        # contiguously in arrival order. Each line then gets one slice copy
+        # into its ring buffers instead of a dict append per sample.
+        line_id_array = np.char.add(
+            np.char.add(np.char.add("pid:", patient_ids),
+                        np.char.add(", did:", device_ids)),
+            np.char.add(", data:" + key + ", type:", types))
+        (unique_line_ids, inverse) = np.unique(line_id_array, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse))
+        sorted_times = timestamps[order]
+        sorted_values = data[order]
+        start = 0
+        for (line_index, line_id) in enumerate(unique_line_ids):
+          end = bounds[line_index]
+          self.append_line_points(line_id, sorted_times[start:end],
+                                  sorted_values[start:end])
+          start = end
+
+        if self.display_limit != -1:
+          points_limit = max(int(self.display_limit), 3)
+        else:
+          points_limit = -1
+
+        for line_id in unique_line_ids:
+          (line_times, line_values) = self.line_points(line_id)
+          (plot_times, plot_values) = downsample(line_times, line_values,
+                                                 points_limit)
+          # Only the plotted slice is converted to date units; datetime64[ms]
+          # keeps the millisecond precision the timestamps are rounded to.
+          plot_dates = (plot_times*1000.0).astype("datetime64[ms]")
+          if line_id not in self.line_styles:
+            style = self.color_cycle[len(self.line_styles) % len(self.color_cycle)]
+            self.line_styles[line_id] = style
+            self.style_groups[style].append(line_id)
+            self.legend_proxies[style] = plt.Line2D(
+                [], [], color=style, label="\n".join(self.style_groups[style]))
+            lines_added = True
+          self.line_plot_points[line_id] = (plot_dates, plot_values)
+          styles_updated.add(self.line_styles[line_id])
+
+      # Rebuild the merged artist of every style whose segments changed. The
+      # separators render as gaps, so the segments stay visually distinct lines.
+      for style in styles_updated:
+        date_segments = []
+        value_segments = []
+        for line_id in self.style_groups[style]:
+          (plot_dates, plot_values) = self.line_plot_points[line_id]
+          date_segments.extend((plot_dates, _date_separator))
+          value_segments.extend((plot_values, _value_separator))
+        merged_dates = np.concatenate(date_segments[:-1])
+        merged_values = np.concatenate(value_segments[:-1])
+        if style in self.lines:
+          self.lines[style].set_data(merged_dates, merged_values)
+        else:
+          self.lines[style], = self.axes.plot(merged_dates, merged_values,
+                                              color=style, animated=True)
+
+      monotonic_processed = time.monotonic()
+      time_to_process = monotonic_processed - monotonic_entry
+      if data_processed > 0:
+        self.process_time_ema = ((1.0 - self.ema_weight)*self.process_time_ema +
+                                 self.ema_weight*time_to_process)
+        ratio = self.process_period/max(self.process_time_ema, 1e-6)
+        ratio = max(0.5, min(2.0, ratio))
+        self.aggregation_limit = int(max(self.min_limit,
+                                         min(self.max_limit,
+                                             self.aggregation_limit*ratio)))
 
       # Plot Time
-      start_time_to_plot = time.time()
+      previous_limits = (self.axes.get_xlim(), self.axes.get_ylim())
       self.axes.relim()
       self.axes.autoscale_view()
       # Based on the concept that a human can only keep track of 7 things in their
-      # mind at once. But this is a bit arbitrary and is implemented for 
+      # mind at once. But this is a bit arbitrary and is implemented for
       # efficiency purposes.
       if len(self.lines) <= 7 and self.total_data > 0:
-        self.axes.legend()
-
-      # Refresh the figure 
-      if self.figure.stale:
-        self.figure.canvas.draw_idle()
+        self.axes.legend(handles=list(map(lambda style: self.legend_proxies[style],
+                                          self.style_groups)))
+
+      # Refresh the figure. While the axis limits and the set of lines hold
+      # steady only the line artists are redrawn over the saved background and
+      # blitted, which skips re-rendering the axes, ticks, and legend. A limit
+      # or line change falls back to a full draw and recaptures the background.
+      limits = (self.axes.get_xlim(), self.axes.get_ylim())
+      if self.background == None or lines_added or limits != previous_limits:
+        self.figure.canvas.draw()
+        self.background = self.figure.canvas.copy_from_bbox(self.axes.bbox)
+        for line in self.lines.values():
+          self.axes.draw_artist(line)
+        self.figure.canvas.blit(self.axes.bbox)
         # Pushes graph to foreground. This may be desirable in some situations.
         #plt.show(block=False)
-        self.figure.canvas.start_event_loop(0.001)
-      else:
-        time.sleep(0.001)
-
-      actual_refresh_period = time.time() - self.time_plotted
-      self.time_plotted = time.time()
-      time_to_plot = time.time() - start_time_to_plot
-      if self.display_limit != -1:
-        if time_to_plot > self.plot_period:
-          self.display_limit /= 2
-        elif self.total_data > self.display_limit:
-          self.display_limit += data_processed
+        self.refresh_canvas()
+      elif data_processed > 0:
+        self.figure.canvas.restore_region(self.background)
+        for line in self.lines.values():
+          self.axes.draw_artist(line)
+        self.figure.canvas.blit(self.axes.bbox)
+        self.refresh_canvas()
+
+      monotonic_plotted = time.monotonic()
+      actual_refresh_period = monotonic_plotted - self.time_plotted
+      self.time_plotted = monotonic_plotted
+      time_to_plot = monotonic_plotted - monotonic_processed
+      if self.display_limit != -1 and data_processed > 0:
+        self.plot_time_ema = ((1.0 - self.ema_weight)*self.plot_time_ema +
+                              self.ema_weight*time_to_plot)
+        ratio = self.plot_period/max(self.plot_time_ema, 1e-6)
+        ratio = max(0.5, min(2.0, ratio))
+        self.display_limit = int(max(self.min_limit,
+                                     min(self.max_limit,
+                                         self.display_limit*ratio)))
 
       self.state = "aggregate"
       self.aggregation_buffer = []
 
+    monotonic_now = time.monotonic()
     if (self.system_samples and
-        (time.time() - self.system_samples_updated > self.system_samples_period)):
+        (monotonic_now - self.system_samples_updated > self.system_samples_period)):
       sample_type = "system_samples"
       if self.app != "":
         sample_type += "_" + self.app
       patient_id = "visualize"
       device_id = self.keys
-      visualized_data_per_s = self.visualized_data/(time.time() -
+      visualized_data_per_s = self.visualized_data/(monotonic_now -
                                                     self.system_samples_updated)
       sample = {"throughput":visualized_data_per_s,
                 "aggregation_limit":self.aggregation_limit,
@@ -220,29 +530,173 @@ class PimapVisualizePltGraph:
         sample["latency"] = np.mean(self.latencies)
       pimap_system_samples.append(pu.create_pimap_sample(sample_type, patient_id,
                                                          device_id, sample))
-      self.system_samples_updated = time.time()
+      self.system_samples_updated = monotonic_now
       self.latencies = []
       self.visualized_data = 0
 
     return pimap_system_samples
 
+  def refresh_canvas(self):
+    """Finishes a canvas refresh for the selected backend.
+
+    An interactive backend gets its pending GUI events processed; the
+    non-interactive agg backend instead exposes the rendered frame in
+    rgba_buffer for a client to stream or write out.
+    """
+    if self.interactive:
+      self.figure.canvas.flush_events()
+    else:
+      self.rgba_buffer = self.figure.canvas.buffer_rgba()
+
+  def append_line_points(self, line_id, timestamps, values):
+    """Appends points to a line's ring buffers.
+
+    Each line stores epoch seconds and values in two preallocated float arrays
+    with a write head, so an append is a slice copy and nothing is reallocated
+    or boxed per point. Once a buffer is full the oldest points are overwritten.
+
+    Arguments:
+      line_id: The line to append to.
+      timestamps: A list of epoch seconds.
+      values: A list of values aligned with timestamps.
+    """
+    capacity = self.line_capacity
+    if line_id not in self.line_buffers:
+      self.line_buffers[line_id] = [np.empty(capacity), np.empty(capacity), 0, 0]
+    buffers = self.line_buffers[line_id]
+    (times, data, head, count) = buffers
+    size = len(timestamps)
+    if size >= capacity:
+      times[:] = timestamps[size - capacity:]
+      data[:] = values[size - capacity:]
+      buffers[2] = 0
+      buffers[3] = capacity
+      return
+    end = head + size
+    if end <= capacity:
+      times[head:end] = timestamps
+      data[head:end] = values
+    else:
+      first = capacity - head
+      times[head:] = timestamps[:first]
+      data[head:] = values[:first]
+      times[:end - capacity] = timestamps[first:]
+      data[:end - capacity] = values[first:]
+    buffers[2] = end % capacity
+    buffers[3] = min(count + size, capacity)
+
+  def line_points(self, line_id):
+    """Returns a line's points in insertion order.
+
+    Arguments:
+      line_id: The line to read.
+
+    Returns:
+      A (timestamps, values) tuple of float arrays, oldest point first.
+    """
+    (times, data, head, count) = self.line_buffers[line_id]
+    if count < self.line_capacity or head == 0:
+      return (times[:count], data[:count])
+    return (np.concatenate((times[head:], times[:head])),
+            np.concatenate((data[head:], data[:head])))
+
   def save(self, location):
     """Save the current graph as a pickle.
 
+    The lines are saved as arrays of epoch seconds and values. Pickles written
+    by older versions stored datetimes instead; the loader below accepts both.
+
     Arguments:
       location: The location to save the pickle. For example if location is
         "visualize.pickle" the graph will be saved in the current directory with the
         name "visualize.pickle". It can be reopened using:
         python pimapvisualizepltgraph.py location.
     """
+    plot_times = {}
+    plot_data = {}
+    for line_id in self.line_buffers:
+      (plot_times[line_id], plot_data[line_id]) = self.line_points(line_id)
+    # Protocol 5 writes the arrays as raw buffers instead of re-encoding each
+    # element, so a save is limited by disk bandwidth.
     with open(location, "wb") as f:
       pickle.dump((self.title, self.axes.get_xlabel(), self.axes.get_ylabel(),
-                   self.plot_dates, self.plot_data), f)
+                   plot_times, plot_data), f, protocol=5)
 
   def close(self):
     """Closes the Matplotlib figure."""
     plt.close(self.figure)
 
+class PimapVisualizePltGraphProcess:
+  """ Runs a PimapVisualizePltGraph in a worker process.
+
+  visualize() only queues the data and returns, so the caller is decoupled from
+  matplotlib's draw time: a pipeline runs at the slower of the producer and the
+  visualizer instead of their sum.
+  """
+  def __init__(self, keys, system_samples=False, app="", backend=None,
+               line_capacity=65536):
+    """Constructor for PIMAP Visualize Plt Graph Process
+
+    Arguments: The arguments of PimapVisualizePltGraph, which the worker
+      process passes through to the graph it constructs.
+
+    Exceptions:
+      TypeError:
+        If keys is not a list.
+    """
+    if not isinstance(keys, list):
+      raise TypeError("The argument keys must be a list")
+
+    self.running = multiprocessing.Value(ctypes.c_bool, True)
+    self.pimap_data_queue = multiprocessing.Queue()
+    self.system_samples_queue = multiprocessing.Queue()
+    self.worker_process = multiprocessing.Process(
+        target=_visualize_worker,
+        args=(keys, system_samples, app, backend, line_capacity, self.running,
+              self.pimap_data_queue, self.system_samples_queue))
+    self.worker_process.daemon = True
+    self.worker_process.start()
+
+  def visualize(self, pimap_data):
+    """Queues the given pimap_data for the worker without blocking.
+
+    Arguments:
+      pimap_data: A list of PIMAP data.
+
+    Returns:
+      Any system samples the worker produced since the last call.
+
+    Exceptions:
+      TypeError:
+        If pimap_data is not a list.
+    """
+    if not isinstance(pimap_data, list):
+      raise TypeError("The argument pimap_data must be a list.")
+
+    if len(pimap_data) > 0:
+      self.pimap_data_queue.put(pimap_data)
+    pimap_system_samples = []
+    try:
+      while True:
+        pimap_system_samples.extend(self.system_samples_queue.get_nowait())
+    except queue.Empty:
+      pass
+    return pimap_system_samples
+
+  def close(self):
+    """Stops the worker process and closes its figure."""
+    self.running.value = False
+    # Empty queues or the process won't join.
+    try:
+      while True: self.pimap_data_queue.get_nowait()
+    except queue.Empty:
+      pass
+    try:
+      while True: self.system_samples_queue.get_nowait()
+    except queue.Empty:
+      pass
+    self.worker_process.join()
+
 def print_usage_and_exit():
   print("Usage:")
   print("   pimapvisualizepltgraph.py 'pickle_file_path'")
@@ -261,8 +715,13 @@ if __name__ == "__main__":
   markers = ["o", "v", "s", "+", "*", "1", "8", "p", "x"]
   i = 0
   for line_id in sorted(plot_dates):
+    dates = np.asarray(plot_dates[line_id])
+    # New pickles store epoch seconds; old pickles store datetimes, which come
+    # out as an object array and plot as they are.
+    if dates.dtype.kind == "f":
+      dates = (dates*1000.0).astype("datetime64[ms]")
     # Plot raw data
-    plt.plot(plot_dates[line_id], plot_data[line_id], label=line_id)
+    plt.plot(dates, plot_data[line_id], label=line_id)
     # Plot filtered data by line_id
     #if line_id.find("store") != -1:
     #  plt.plot(plot_dates[line_id], plot_data[line_id], label=line_id,
@@ -8,12 +8,18 @@ Author: Sam Mansfield
 """
 import ast
 import socket
+import sys
 import threading
 import time
 import unittest
 from pimap import pimapsenseudp as pseu
 from pimap import pimaputilities as pu
 
+# Linux lets a UDP sender skip computing the outgoing checksum, which is pure
+# overhead on loopback where nothing can corrupt the datagram in flight. The
+# socket module does not expose the constant.
+SO_NO_CHECK = 11
+
 class PimapSenseUdpTestCase(unittest.TestCase):
   def test_creating_and_closing_correct_usage(self):
     # Test using default values.
@@ -71,6 +77,15 @@ class PimapSenseUdpTestCase(unittest.TestCase):
     for worker in sense.worker_processes:
       self.assertFalse(worker.is_alive())
 
+    # Test using the local AF_UNIX mode.
+    sense = pseu.PimapSenseUdp(local=True)
+    self.assertEqual(sense.socket.family, socket.AF_UNIX)
+    for worker in sense.worker_processes:
+      self.assertTrue(worker.is_alive())
+    sense.close()
+    for worker in sense.worker_processes:
+      self.assertFalse(worker.is_alive())
+
     # Test with system_samples
     sense = pseu.PimapSenseUdp(system_samples=True)
     time.sleep(sense.system_samples_period)
@@ -108,15 +123,30 @@ class PimapSenseUdpTestCase(unittest.TestCase):
     # Test pimap data without system_samples.
     sense = pseu.PimapSenseUdp()
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sample_type = "test_type" 
+    # A large send buffer on the client side keeps the burst in the kernel
+    # instead of dropping datagrams the assertions below expect to arrive.
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8*1024*1024)
+    if sys.platform.startswith("linux"):
+      s.setsockopt(socket.SOL_SOCKET, SO_NO_CHECK, 1)
+    # Connecting resolves the server address once; each send is then a single
+    # syscall without the per-packet address lookup that sendto pays.
+    s.connect((sense.host, sense.port))
+    sample_type = "test_type"
     patient_id = "test"
     device_id = "1"
     sample = 0
+    # Only the sample counter and the timestamp change between packets, so the
+    # invariant prefix is built once instead of create_pimap_sample
+    # re-validating every field per packet. The result is byte-identical to
+    # what create_pimap_sample produces.
+    sample_prefix = ("sample_type:" + sample_type + ";patient_id:" + patient_id +
+                     ";device_id:" + device_id + ";sample:")
     sent_pimap_samples = []
     stop_time = time.time() + sense.system_samples_period
     while time.time() < stop_time:
-      pimap_sample = pu.create_pimap_sample(sample_type, patient_id, device_id, sample)
-      s.sendto(pimap_sample.encode(), (sense.host, sense.port))
+      pimap_sample = (sample_prefix + str(sample) + ";timestamp:" +
+                      str(time.time()) + ";;")
+      s.send(pimap_sample.encode())
       sent_pimap_samples.append(pimap_sample)
       sample += 1
     s.close()
@@ -126,9 +156,9 @@ class PimapSenseUdpTestCase(unittest.TestCase):
       sensed_pimap_samples.extend(sense.sense())
     sense.close()
 
-    self.assertEqual(len(sent_pimap_samples), len(sensed_pimap_samples))
-    for sent_psample, sensed_psample in zip(sent_pimap_samples, sensed_pimap_samples):
-      self.assertEqual(sent_psample, sensed_psample)
+    # A single list comparison runs element-by-element in C instead of paying
+    # unittest bookkeeping per sample.
+    self.assertEqual(sent_pimap_samples, sensed_pimap_samples)
 
     # Test generic data without system_samples.
     # Because the timestamps are generated by the receiver when receiving generic data
@@ -137,16 +167,20 @@ class PimapSenseUdpTestCase(unittest.TestCase):
     # because the out of order packets occurred because of the parallel sense workers.
     sense = pseu.PimapSenseUdp(workers=1)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8*1024*1024)
+    if sys.platform.startswith("linux"):
+      s.setsockopt(socket.SOL_SOCKET, SO_NO_CHECK, 1)
     shost = "127.0.0.1"
     sport = 3500
     addr_info =  socket.getaddrinfo(shost, sport, socket.AF_INET, socket.SOCK_DGRAM)
     addr = addr_info[0][4]
     s.bind(addr)
+    s.connect((sense.host, sense.port))
     data = 0
     sent_data = []
     stop_time = time.time() + sense.system_samples_period
     while time.time() < stop_time:
-      s.sendto(str(data).encode(), (sense.host, sense.port))
+      s.send(str(data).encode())
       sent_data.append(data)
       data += 1
     sock_name = s.getsockname()
@@ -171,31 +205,35 @@ class PimapSenseUdpTestCase(unittest.TestCase):
     # Test pimap data with system_samples.
     sense = pseu.PimapSenseUdp(system_samples=True)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8*1024*1024)
+    if sys.platform.startswith("linux"):
+      s.setsockopt(socket.SOL_SOCKET, SO_NO_CHECK, 1)
+    s.connect((sense.host, sense.port))
     sample_type = "test_type"
     patient_id = "test"
     device_id = "1"
     sample = 0
+    sample_prefix = ("sample_type:" + sample_type + ";patient_id:" + patient_id +
+                     ";device_id:" + device_id + ";sample:")
     sent_pimap_samples = []
     stop_time = time.time() + sense.system_samples_period
     while time.time() < stop_time:
-      pimap_sample = pu.create_pimap_sample(sample_type, patient_id, device_id, sample)
-      s.sendto(pimap_sample.encode(), (sense.host, sense.port))
+      pimap_sample = (sample_prefix + str(sample) + ";timestamp:" +
+                      str(time.time()) + ";;")
+      s.send(pimap_sample.encode())
       sent_pimap_samples.append(pimap_sample)
       sample += 1
-    s.close() 
+    s.close()
 
     sensed_samples = []
     while len(sensed_samples) < len(sent_pimap_samples):
       sensed_samples.extend(sense.sense())
     sense.close()
 
-    sensed_system_samples = list(filter(lambda x: pu.get_type(x) == "system_samples",
-                                        sensed_samples))
-    sensed_pimap_samples = list(filter(lambda x: pu.get_type(x) == "test_type",
-                                       sensed_samples))
-    self.assertEqual(len(sent_pimap_samples), len(sensed_pimap_samples))
-    for sent_psample, sensed_psample in zip(sent_pimap_samples, sensed_pimap_samples):
-      self.assertEqual(sent_psample, sensed_psample)
+    sensed_by_type = pu.partition_by_type(sensed_samples)
+    sensed_system_samples = sensed_by_type.get("system_samples", [])
+    sensed_pimap_samples = sensed_by_type.get("test_type", [])
+    self.assertEqual(sent_pimap_samples, sensed_pimap_samples)
 
     self.assertTrue(len(sensed_system_samples) > 0)
     system_sample = sensed_system_samples[0]
@@ -203,5 +241,27 @@ class PimapSenseUdpTestCase(unittest.TestCase):
     throughput = sample["throughput"]
     self.assertTrue(throughput > 0.0)
 
+    # Test pimap data using the local AF_UNIX mode, which bypasses the IP/UDP
+    # stack for same-machine senders.
+    sense = pseu.PimapSenseUdp(local=True)
+    s = pseu.local_sender(sense.port)
+    sample = 0
+    sent_pimap_samples = []
+    stop_time = time.time() + sense.system_samples_period
+    while time.time() < stop_time:
+      pimap_sample = (sample_prefix + str(sample) + ";timestamp:" +
+                      str(time.time()) + ";;")
+      s.send(pimap_sample.encode())
+      sent_pimap_samples.append(pimap_sample)
+      sample += 1
+    s.close()
+
+    sensed_pimap_samples = []
+    while len(sensed_pimap_samples) < len(sent_pimap_samples):
+      sensed_pimap_samples.extend(sense.sense())
+    sense.close()
+
+    self.assertEqual(sent_pimap_samples, sensed_pimap_samples)
+
 if __name__ == "__main__":
     unittest.main()
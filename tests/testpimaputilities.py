@@ -235,6 +235,24 @@ class PimapUtilitiesTestCase(unittest.TestCase):
     gotten_metric = ast.literal_eval(gotten_metric_string)
     self.assertEqual(gotten_metric, metric)
 
+  def test_partition_by_type_correct_usage(self):
+    sample_type = "test_sample"
+    patient_id = "Aaron"
+    device_id = "1"
+    timestamp = str(time.time())
+    pimap_samples = []
+    for sample in range(3):
+      pimap_samples.append(pu.create_pimap_sample(sample_type, patient_id, device_id,
+                                                  sample, timestamp))
+    metric_type = "test_metric"
+    metric = {"new_analysis":5}
+    pimap_metric = pu.create_pimap_metric(metric_type, pimap_samples[0], metric)
+
+    partitioned = pu.partition_by_type(pimap_samples + [pimap_metric])
+    self.assertEqual(partitioned[sample_type], pimap_samples)
+    self.assertEqual(partitioned[metric_type], [pimap_metric])
+    self.assertEqual(pu.partition_by_type([]), {})
+
   def test_validate_datum_correct_usage(self):
     sample_type = "test_sample"
     patient_id = "Aaron"